@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for the display modes.  Runs each mode through the real output
+# drivers against in-memory stand-ins for the strip and the PCA9685, so it works
+# anywhere numpy does.
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+import dionysus
+
+class FakeStrip(object):
+    """Just enough of Adafruit_NeoPixel to render into a list."""
+
+    def __init__(self, num):
+        self.leds  = [0] * num
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self.leds)
+
+    def setPixelColor(self, n, color):
+        self.leds[n] = color
+
+    def __setitem__(self, pos, value):
+        if isinstance(pos, slice):
+            for n in range(*pos.indices(len(self.leds))):
+                self.leds[n] = value[n]
+        else:
+            self.leds[pos] = value
+
+    def show(self):
+        self.shows += 1
+
+class FakeI2C(object):
+    """Just enough of an Adafruit_GPIO I2C device to count transactions."""
+
+    def __init__(self):
+        self.registers = [0] * 256
+        self.writes    = 0
+
+    def readU8(self, register):
+        return self.registers[register]
+
+    def write8(self, register, value):
+        self.registers[register] = value
+        self.writes += 1
+
+    def writeList(self, register, data):
+        self.registers[register:register + len(data)] = data
+        self.writes += 1
+
+class FakePWM(object):
+    """Just enough of Adafruit_PCA9685.PCA9685 to count register writes."""
+
+    def __init__(self):
+        self.channels = [(0, 0)] * 16
+        self.writes   = 0
+        self._device  = FakeI2C()
+
+    def set_pwm_freq(self, freq_hz):
+        pass
+
+    def set_pwm(self, channel, on, off):
+        self.channels[channel] = (on, off)
+        self.writes += 1
+
+def beat_stream(frames, fps=60, bpm=120.0):
+    """Synthetic (is_beat, volume) pairs: a steady beat with a wandering, beat-pumped volume."""
+    frames_per_beat = int(fps * 60.0 / bpm)
+    level = 0.01
+    for n in range(frames):
+        is_beat = n % frames_per_beat == 0
+        level = min(max(level * random.uniform(0.9, 1.1), 0.0001), 0.1)
+        yield is_beat, level * (2.0 if is_beat else 1.0)
+
+def bench_mode(mode_class, length, frames, trace_allocs=True, null_output=False):
+    if null_output:
+        strip = dionysus.NullPixelDriver(length)
+        pwm = dionysus.NullPWMDriver()
+    else:
+        fake_pwm = FakePWM()
+        strip = dionysus.WS281xDriver(FakeStrip(length))
+        pwm = dionysus.PCA9685Driver(fake_pwm)
+        fake_pwm.writes = fake_pwm._device.writes = 0
+    hx = [dionysus.LED(pwm, i * 3, i * 3 + 1, i * 3 + 2) for i in range(5)]
+    # frames are 1/60 s apart however long they really take, so every run sees the same timing
+    clock = dionysus.VirtualClock()
+    thruster = dionysus.Thruster(pwm, 15, clock)
+
+    mode = mode_class(strip, hx, clock=clock)
+    stream = list(beat_stream(frames))
+
+    # warm up caches and get the first full-strip write out of the way
+    for is_beat, volume in stream[:30]:
+        mode.go_wrap(is_beat, volume)
+
+    latencies = np.zeros(frames)
+    for n, (is_beat, volume) in enumerate(stream):
+        clock.sleep(1.0 / 60)
+        clock.tick()
+        t0 = time.perf_counter()
+        if is_beat:
+            thruster.blink()
+        mode.go_wrap(is_beat, volume)
+        thruster.go()
+        pwm.show()
+        latencies[n] = time.perf_counter() - t0
+
+    # separate pass, since tracing slows everything down
+    alloc_kib = float("nan")
+    if trace_allocs:
+        transient = np.zeros(frames)
+        tracemalloc.start()
+        for n, (is_beat, volume) in enumerate(stream):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            mode.go_wrap(is_beat, volume)
+            transient[n] = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        alloc_kib = transient.mean() / 1024.0
+
+    return {
+        "fps":       frames / latencies.sum(),
+        "p50":       np.percentile(latencies, 50) * 1000.0,
+        "p90":       np.percentile(latencies, 90) * 1000.0,
+        "p99":       np.percentile(latencies, 99) * 1000.0,
+        "max":       latencies.max() * 1000.0,
+        "alloc_kib": alloc_kib,
+        "i2c":       0.0 if null_output else (fake_pwm.writes + fake_pwm._device.writes) / float(frames),
+    }
+
+MODES = {
+    "Shimmer":      dionysus.Shimmer,
+    "Chase":        dionysus.Chase,
+    "Shift":        dionysus.Shift,
+    "ShootingStar": dionysus.ShootingStar,
+}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the Dionysus display modes without hardware")
+    parser.add_argument("--sizes", default="130,1000,10000",
+            help="comma-separated LED counts to run (default: 130,1000,10000)")
+    parser.add_argument("--modes", default=",".join(MODES),
+            help="comma-separated modes to run (default: all)")
+    parser.add_argument("--frames", type=int, default=600, help="frames per run (default: 600)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: 1)")
+    parser.add_argument("--no-allocs", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--null-output", action="store_true",
+            help="render into null drivers instead of the fake devices, to time rendering alone")
+    args = parser.parse_args()
+
+    print("%-13s %6s %9s %8s %8s %8s %8s %10s %7s" % (
+        "mode", "leds", "fps", "p50 ms", "p90 ms", "p99 ms", "max ms", "KiB/frame", "i2c/f"))
+
+    for size in [int(x) for x in args.sizes.split(",")]:
+        for name in args.modes.split(","):
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+            r = bench_mode(MODES[name], size, args.frames, not args.no_allocs, args.null_output)
+            print("%-13s %6s %9.1f %8.3f %8.3f %8.3f %8.3f %10.1f %7.2f" % (
+                name, size, r["fps"], r["p50"], r["p90"], r["p99"], r["max"], r["alloc_kib"], r["i2c"]))
@@ -1,19 +1,48 @@
 #!/usr/bin/env python3
 
 import time
-from rpi_ws281x import *
-import Adafruit_PCA9685
 import argparse
 import colorsys
+import math
 
-import aubio
 import numpy as np
-import pyaudio
 import wave
 
+# The hardware and audio libraries only exist on the Pi.  Everything that talks to them
+# takes the device as an argument, so the modes can be imported and run anywhere.
+try:
+    from rpi_ws281x import *
+    import _rpi_ws281x as ws # the low-level API, for driving both channels at once
+except ImportError:
+    ws = None
+    WS2812_STRIP = None
+    def Color(red, green, blue, white=0):
+        return (white << 24) | (red << 16) | (green << 8) | blue
+
+try:
+    import Adafruit_PCA9685
+except ImportError:
+    Adafruit_PCA9685 = None
+
+try:
+    import aubio
+except ImportError:
+    aubio = None
+
+# only the live audio needs PyAudio; --analyze works from files with just aubio
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+import json
+import os
 import random
 import sys
 import copy
+import signal
+import struct
+import threading
 
 import multiprocessing # Hold onto your butts.
 
@@ -25,6 +54,23 @@ LED_BRIGHTNESS = 255     # Set to 0 for darkest and 255 for brightest
 LED_INVERT     = False   # True to invert the signal (when using NPN transistor level shift)
 LED_CHANNEL    = 0       # set to '1' for GPIOs 13, 19, 41, 45 or 53
 LED_STRIP      = WS2812_STRIP
+LED_CHANNEL_PINS = {0: LED_PIN, 1: 13} # GPIO for each channel when driving both (1 needs 13, 19, 41, 45 or 53)
+
+# Where the logical strip that the modes draw on physically is: segments, in logical
+# order, of (channel, offset, count, reversed), meaning `count` pixels starting `offset`
+# pixels down the chain on channel 0 or 1, running backwards if reversed.  Anything more
+# than one plain segment goes out through WS281xMultiDriver.  See also --layout.
+LED_LAYOUT = [(LED_CHANNEL, 0, LED_COUNT, False)]
+
+profiler = None # set to a Profiler to collect hot-path timings
+
+AUDIO_SAMPLERATE = 44100
+AUDIO_WIN_S      = 2048 # fft size; beats come out of aubio about this far behind the music
+
+# Band energies published with every audio hop.  Either a list of triangle filter corner
+# frequencies, where band i rises from freqs[i] to a peak at freqs[i+1] and falls to
+# freqs[i+2] (so n bands take n+2 frequencies), or an int for that many mel bands.
+AUDIO_BANDS = [40.0, 120.0, 500.0, 2500.0, 10000.0] # bass, mid, treble
 
 def float_close(a, b):
     return abs(a-b) <= 0.00001
@@ -37,6 +83,40 @@ def cmp_color(a,b,proximity=0.00001):
             return False
     return True
 
+class Clock(object):
+    """The monotonic clock, sampled once per frame.  tick() takes the sample and
+    everything rendering that frame reads it from now, so a frame sees one time.
+    read() and sleep() are for the frame scheduler, which needs the real thing."""
+
+    def __init__(self):
+        self.now = self.read()
+
+    def read(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def tick(self):
+        self.now = self.read()
+        return self.now
+
+class VirtualClock(Clock):
+    """A clock that only moves when slept on, for rendering, benchmarks and tests at
+    whatever speed the CPU allows."""
+
+    def __init__(self, start=0.0):
+        self.time = start
+        super(VirtualClock, self).__init__()
+
+    def read(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+frame_clock = Clock() # shared by anything that isn't handed its own
+
 class LED(object):
 
     def __init__(self, pwm, r_pin,g_pin,b_pin):
@@ -52,38 +132,56 @@ class LED(object):
             hls = colorsys.rgb_to_hls(rgb[0],rgb[1],rgb[2])
             self.hsl = [hls[0],hls[2],hls[1]]
             for i in range(3):
-                if rgb[i] < 0.01: # this seems like the most reasonable possible cutoff
-                    pwm.set_pwm(self.pins[i], 0, 0)
-                else:
-                    on = 4096 - int(4096 * rgb[i])
-                    pwm.set_pwm(self.pins[i], on, 4095)
+                self.pwm.set_level(self.pins[i], rgb[i])
 
     def get_hsl(self):
         return self.hsl.copy()
 
 class Thruster(object):
 
-    def __init__(self, pwm, pin):
+    def __init__(self, pwm, pin, clock=None):
         self.pwm = pwm
         self.pin = pin
+        self.clock = clock or frame_clock
         self.brightness = 0.0
-        self.last_time = time.time()
+        self.last_time = self.clock.now
 
     def blink(self):
         self.brightness = 0.0
-        self.last_time = time.time()
+        self.last_time = self.clock.now
 
     def go(self):
         if self.brightness < 1.0:
-            self.brightness = min(1.0, (time.time() - self.last_time) * 4.0 - 0.5) # 1/4 second fade time and 1/4 second black
+            self.brightness = min(1.0, (self.clock.now - self.last_time) * 4.0 - 0.5) # 1/4 second fade time and 1/4 second black
             self.set(self.brightness)
 
     def set(self, level):
-        if level < 0.01:
-            self.pwm.set_pwm(self.pin, 0, 0)
-        else:
-            on = 4096 - int(4096 * level)
-            self.pwm.set_pwm(self.pin, on, 4095)
+        self.pwm.set_level(self.pin, level)
+
+ONE_THIRD = 1.0 / 3.0
+ONE_SIXTH = 1.0 / 6.0
+TWO_THIRD = 2.0 / 3.0
+
+def hsl_to_rgb_array(hsl):
+    """Batched colorsys.hls_to_rgb() over an Nx3 array of HSL rows; returns Nx3 RGB floats."""
+    h = hsl[:,0]
+    s = hsl[:,1]
+    l = hsl[:,2]
+    m2 = np.where(l <= 0.5, l * (1.0 + s), l + s - (l * s))
+    m1 = 2.0 * l - m2
+    rgb = np.empty((len(hsl), 3))
+    for i, offset in enumerate((ONE_THIRD, 0.0, -ONE_THIRD)):
+        hue = (h + offset) % 1.0
+        rgb[:,i] = np.where(hue < ONE_SIXTH, m1 + (m2 - m1) * hue * 6.0,
+                   np.where(hue < 0.5, m2,
+                   np.where(hue < TWO_THIRD, m1 + (m2 - m1) * (TWO_THIRD - hue) * 6.0,
+                   m1)))
+    return rgb
+
+def pack_rgb(rgb):
+    """Pack Nx3 RGB floats (0.0-1.0) into the 24-bit ints that Color() produces."""
+    c = np.clip(rgb * 255, 0, 255).astype(np.uint32)
+    return (c[:,0] << 16) | (c[:,1] << 8) | c[:,2]
 
 def colorWipe(strip, color, wait_ms=50):
     """Wipe color across display a pixel at a time."""
@@ -91,625 +189,1440 @@ def colorWipe(strip, color, wait_ms=50):
         strip.setPixelColor(i, color)
     strip.show()
 
+# Output drivers.  Modes and lights only ever hand over whole frames, so what happens to
+# them (hardware, nothing, a recording) is up to whichever driver main() plugs in.
+
+class PixelDriver(object):
+    """Takes whole frames of packed 24-bit colors, one uint32 per pixel."""
+
+    def __init__(self, length):
+        self.length = length
+
+    def write_frame(self, frame):
+        """Send a frame; returns how many pixels actually went out."""
+        raise NotImplementedError
+
+class WS281xDriver(PixelDriver):
+    """An rpi_ws281x strip.  Only pixels that changed since the last frame are written,
+    and show() is skipped entirely when nothing changed."""
+
+    def __init__(self, strip):
+        super(WS281xDriver, self).__init__(strip.numPixels())
+        self.strip = strip
+
+        self.shadow = np.zeros(self.length, dtype=np.uint32)
+        self.shadow_valid = False
+
+    def write_frame(self, frame):
+        if not self.shadow_valid:
+            self.strip[0:self.length] = frame.tolist()
+            written = self.length
+            self.shadow_valid = True
+        else:
+            changed = np.flatnonzero(frame != self.shadow)
+            written = len(changed)
+            if written == 0:
+                return 0
+            for i, c in zip(changed.tolist(), frame[changed].tolist()):
+                self.strip.setPixelColor(i, c)
+
+        self.shadow[:] = frame
+        self.strip.show()
+        return written
+
+class StripLayout(object):
+    """Maps the logical strip onto the physical one (see LED_LAYOUT).  The physical
+    pixels of every channel are laid end to end, in channel order, and remap holds
+    the logical pixel for each of them.  Physical pixels that no segment covers show
+    black."""
+
+    def __init__(self, segments):
+        self.segments = [(int(c), int(o), int(n), bool(r)) for c, o, n, r in segments]
+        self.length = sum(n for c, o, n, r in self.segments)
+
+        self.channels = {} # channel -> pixels on it
+        for channel, offset, count, rev in self.segments:
+            if channel not in (0, 1) or offset < 0 or count < 0:
+                raise ValueError("bad segment %s" % ((channel, offset, count, rev),))
+            self.channels[channel] = max(self.channels.get(channel, 0), offset + count)
+        self.starts = {}
+        total = 0
+        for channel in sorted(self.channels):
+            self.starts[channel] = total
+            total += self.channels[channel]
+
+        # logical index `length` is the black pixel on the end of the padded frame
+        self.remap = np.full(total, self.length, dtype=np.intp)
+        logical = 0
+        for channel, offset, count, rev in self.segments:
+            dest = self.remap[self.starts[channel] + offset:self.starts[channel] + offset + count]
+            if (dest != self.length).any():
+                raise ValueError("segments overlap on channel %d" % channel)
+            dest[:] = np.arange(logical, logical + count)[::-1 if rev else 1]
+            logical += count
+
+        self.padded = np.zeros(self.length + 1, dtype=np.uint32)
+
+    def is_plain(self):
+        """True for one segment that starts at the beginning of its channel and runs forwards."""
+        return len(self.segments) == 1 and self.segments[0][1] == 0 and not self.segments[0][3]
+
+    def map(self, frame, out):
+        """Scatter a logical frame into out, the physical pixels of every channel."""
+        self.padded[:self.length] = frame
+        np.take(self.padded, self.remap, out=out)
+
+def load_layout(path):
+    """A layout from a JSON list of [channel, offset, count, reversed] segments."""
+    with open(path) as f:
+        return json.load(f)
+
+class WS281xMultiDriver(PixelDriver):
+    """Strips on both of the ws281x library's PWM channels, set up in one ws2811_t so a
+    single render clocks them out in parallel, behind a StripLayout.  Like
+    WS281xDriver, only the pixels that changed get written and an unchanged frame
+    isn't rendered at all."""
+
+    def __init__(self, layout, pins=LED_CHANNEL_PINS, freq_hz=LED_FREQ_HZ, dma=LED_DMA,
+            brightness=LED_BRIGHTNESS, invert=LED_INVERT, strip_type=LED_STRIP):
+        super(WS281xMultiDriver, self).__init__(layout.length)
+        self.layout = layout
+
+        self.leds = ws.new_ws2811_t()
+        self.channels = [ws.ws2811_channel_get(self.leds, n) for n in range(2)]
+        for n, channel in enumerate(self.channels):
+            count = layout.channels.get(n, 0)
+            ws.ws2811_channel_t_count_set(channel, count)
+            ws.ws2811_channel_t_gpionum_set(channel, pins[n] if count else 0)
+            ws.ws2811_channel_t_invert_set(channel, int(invert) if count else 0)
+            ws.ws2811_channel_t_brightness_set(channel, brightness if count else 0)
+            if count:
+                ws.ws2811_channel_t_strip_type_set(channel, strip_type)
+        ws.ws2811_t_freq_set(self.leds, freq_hz)
+        ws.ws2811_t_dmanum_set(self.leds, dma)
+
+        resp = ws.ws2811_init(self.leds)
+        if resp != ws.WS2811_SUCCESS:
+            raise RuntimeError("ws2811_init failed with code %d (%s)" % (resp, ws.ws2811_get_return_t_str(resp)))
+
+        # (channel, index on it) for each physical pixel
+        self.targets = []
+        for n in sorted(layout.channels):
+            self.targets.extend((self.channels[n], i) for i in range(layout.channels[n]))
+
+        self.physical = np.zeros(len(layout.remap), dtype=np.uint32)
+        self.shadow = np.zeros(len(layout.remap), dtype=np.uint32)
+        self.shadow_valid = False
+
+    def write_frame(self, frame):
+        self.layout.map(frame, self.physical)
+        if self.shadow_valid:
+            changed = np.flatnonzero(self.physical != self.shadow)
+            if len(changed) == 0:
+                return 0
+        else:
+            changed = np.arange(len(self.physical))
+            self.shadow_valid = True
+
+        targets = self.targets
+        for i, c in zip(changed.tolist(), self.physical[changed].tolist()):
+            channel, pos = targets[i]
+            ws.ws2811_led_set(channel, pos, c)
+        self.shadow[:] = self.physical
+
+        resp = ws.ws2811_render(self.leds)
+        if resp != ws.WS2811_SUCCESS:
+            raise RuntimeError("ws2811_render failed with code %d (%s)" % (resp, ws.ws2811_get_return_t_str(resp)))
+        return len(changed)
+
+    def close(self):
+        """Blank every strip and release the hardware."""
+        self.write_frame(np.zeros(self.length, dtype=np.uint32))
+        ws.ws2811_fini(self.leds)
+        ws.delete_ws2811_t(self.leds)
+
+class NullPixelDriver(PixelDriver):
+    """Throws frames away."""
+
+    def __init__(self, length):
+        super(NullPixelDriver, self).__init__(length)
+        self.frames = 0
+
+    def write_frame(self, frame):
+        self.frames += 1
+        return self.length
+
+class RecordingPixelDriver(PixelDriver):
+    """Keeps a copy of every frame, up to max_frames (None for no limit)."""
+
+    def __init__(self, length, max_frames=None):
+        super(RecordingPixelDriver, self).__init__(length)
+        self.max_frames = max_frames
+        self.frames = []
+
+    def write_frame(self, frame):
+        if self.max_frames is None or len(self.frames) < self.max_frames:
+            self.frames.append(frame.copy())
+        return self.length
+
+class FilePixelDriver(PixelDriver):
+    """Writes frames as RGB bytes into a memory-mapped .npy file of shape
+    (frames, length, 3), for rendering offline.  Frames past the end are dropped."""
+
+    def __init__(self, path, length, frames):
+        super(FilePixelDriver, self).__init__(length)
+        self.frames = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(frames, length, 3))
+        self.count = 0
+
+    def write_frame(self, frame):
+        if self.count < len(self.frames):
+            rgb = self.frames[self.count]
+            rgb[:, 0] = frame >> 16
+            rgb[:, 1] = frame >> 8
+            rgb[:, 2] = frame
+            self.count += 1
+        return self.length
+
+    def close(self):
+        self.frames.flush()
+
+class PWMDriver(object):
+    """The PCA9685's channels as an array of levels (0.0-1.0).  set_level() just stages a
+    value; show() hands the whole frame to write_frame() once per loop."""
+
+    def __init__(self, channels=16):
+        self.levels = np.zeros(channels)
+
+    def set_level(self, channel, level):
+        self.levels[channel] = level
+
+    def show(self):
+        t0 = time.perf_counter()
+        self.write_frame(self.levels)
+        if profiler:
+            profiler.record("pwm", time.perf_counter() - t0)
+
+    def write_frame(self, levels):
+        raise NotImplementedError
+
+PCA9685_MODE1     = 0x00
+PCA9685_AI        = 0x20 # register auto-increment
+PCA9685_LED0_ON_L = 0x06
+I2C_BLOCK_MAX     = 32   # bytes per SMBus block write, i.e. 8 channels
+
+class PCA9685Driver(PWMDriver):
+    """An Adafruit_PCA9685.PCA9685.
+
+    Channels whose register values haven't changed are not written again.  The changed
+    ones go out as auto-increment block writes over runs of neighbouring channels, so a
+    hexagon flip is two I2C transactions instead of fifteen.  With block_writes=False (or
+    a PCA9685 object without an I2C device) it falls back to one set_pwm() per channel.
+    """
+
+    def __init__(self, pwm, channels=16, block_writes=True):
+        super(PCA9685Driver, self).__init__(channels)
+        self.pwm = pwm
+
+        # nothing matches -1, so the first frame clears whatever the last run left behind
+        self.written_on  = np.full(channels, -1, dtype=int)
+        self.written_off = np.full(channels, -1, dtype=int)
+
+        self.regs = np.zeros((channels, 4), dtype=np.uint8)
+
+        self.device = getattr(pwm, "_device", None) if block_writes else None
+        if self.device is not None:
+            self.device.write8(PCA9685_MODE1, self.device.readU8(PCA9685_MODE1) | PCA9685_AI)
+
+    def write_frame(self, levels):
+        # below 1% is off; this seems like the most reasonable possible cutoff
+        lit = levels >= 0.01
+        on  = np.where(lit, 4096 - (4096 * levels).astype(int), 0)
+        off = np.where(lit, 4095, 0)
+
+        changed = np.flatnonzero((on != self.written_on) | (off != self.written_off)).tolist()
+        if changed:
+            if self.device is None:
+                for ch in changed:
+                    self.pwm.set_pwm(ch, int(on[ch]), int(off[ch]))
+            else:
+                self.regs[:,0] = on & 0xFF
+                self.regs[:,1] = on >> 8
+                self.regs[:,2] = off & 0xFF
+                self.regs[:,3] = off >> 8
+                for start, end in self.runs(changed):
+                    self.device.writeList(PCA9685_LED0_ON_L + 4 * start, self.regs[start:end].ravel().tolist())
+            self.written_on[:]  = on
+            self.written_off[:] = off
+
+    @staticmethod
+    def runs(changed, max_channels=I2C_BLOCK_MAX // 4):
+        """Group sorted channel numbers into (start, end) spans for block writes.  A single
+        unchanged channel between two changed ones is cheaper to rewrite than to start a
+        new transaction for, so it gets folded in."""
+        spans = []
+        start = end = changed[0]
+        for ch in changed[1:]:
+            if ch - end <= 2 and ch - start < max_channels:
+                end = ch
+            else:
+                spans.append((start, end + 1))
+                start = end = ch
+        spans.append((start, end + 1))
+        return spans
+
+class NullPWMDriver(PWMDriver):
+    """Throws PWM frames away."""
+
+    def write_frame(self, levels):
+        pass
+
+class RecordingPWMDriver(PWMDriver):
+    """Keeps a copy of every PWM frame, up to max_frames (None for no limit)."""
+
+    def __init__(self, channels=16, max_frames=None):
+        super(RecordingPWMDriver, self).__init__(channels)
+        self.max_frames = max_frames
+        self.frames = []
+
+    def write_frame(self, levels):
+        if self.max_frames is None or len(self.frames) < self.max_frames:
+            self.frames.append(levels.copy())
+
+class OutputThread(threading.Thread):
+    """Pushes frames to the real drivers from a thread of its own, so strip.show() and the
+    I2C writes overlap with rendering the next frame.
+
+    pixel_output and pwm_output stand in for the wrapped drivers.  Each stream has two
+    buffers: the one the thread is writing out and at most one pending frame.  Handing
+    over a frame while one is still pending just replaces it (latest wins), so slow I/O
+    drops frames instead of backing up the renderer.
+
+    The time the real drivers take is profiled here, under the mode "output" with one
+    section per stream; the render thread's own "show" and "pwm" are just the handover.
+    """
+
+    def __init__(self, pixels, pwm):
+        super(OutputThread, self).__init__(name="output", daemon=True)
+        self.drivers = {"pixels": pixels, "pwm": pwm}
+
+        self.cond    = threading.Condition()
+        self.pending = {}
+        self.spare   = {
+            "pixels": [np.zeros(pixels.length, dtype=np.uint32) for i in range(2)],
+            "pwm":    [np.zeros(len(pwm.levels)) for i in range(2)],
+        }
+        self.running = True
+        self.error   = None
+
+        self.pixels_written = 0
+        self.dropped = {"pixels": 0, "pwm": 0} # frames superseded before they went out
+
+        # how long a pixel frame takes from handover to being on the strip, smoothed
+        self.submitted = 0.0
+        self.latency   = 0.0
+
+        self.pixel_output = ThreadedPixelDriver(self, pixels.length)
+        self.pwm_output   = ThreadedPWMDriver(self, len(pwm.levels))
+
+    def submit(self, stream, frame):
+        if self.error is not None:
+            raise self.error
+        with self.cond:
+            buf = self.pending.get(stream)
+            if buf is not None:
+                self.dropped[stream] += 1
+            else:
+                buf = self.spare[stream].pop()
+                self.pending[stream] = buf
+            buf[:] = frame
+            if stream == "pixels":
+                self.submitted = time.monotonic()
+            self.cond.notify()
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    while self.running and not self.pending:
+                        self.cond.wait()
+                    if not self.pending:
+                        return
+                    work = self.pending
+                    self.pending = {}
+                    submitted = self.submitted
+
+                for stream, buf in work.items():
+                    t0 = time.perf_counter()
+                    written = self.drivers[stream].write_frame(buf)
+                    if profiler:
+                        profiler.record(stream, time.perf_counter() - t0, mode="output")
+                    if stream == "pixels":
+                        self.pixels_written = written
+                        self.latency += 0.1 * ((time.monotonic() - submitted) - self.latency)
+
+                with self.cond:
+                    for stream, buf in work.items():
+                        self.spare[stream].append(buf)
+        except Exception as e:
+            print("Error in output thread: %s" % sys.exc_info()[0])
+            self.error = e
+
+    def stop(self):
+        """Finish writing whatever is pending, then exit."""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join()
+
+class ThreadedPixelDriver(PixelDriver):
+    def __init__(self, thread, length):
+        super(ThreadedPixelDriver, self).__init__(length)
+        self.thread = thread
+
+    def write_frame(self, frame):
+        self.thread.submit("pixels", frame)
+        # the real count isn't known until the thread gets to it; report the last one
+        return self.thread.pixels_written
+
+class ThreadedPWMDriver(PWMDriver):
+    def __init__(self, thread, channels):
+        super(ThreadedPWMDriver, self).__init__(channels)
+        self.thread = thread
+
+    def write_frame(self, levels):
+        self.thread.submit("pwm", levels)
+
+class Profiler(object):
+    """Rolling per-mode timings of the hot paths.
+
+    Each (mode, section) keeps the last `window` samples in a ring; histograms are only
+    built when dumping, so recording is just an array store.  Sections are "go", "hsl",
+    "show", "pwm" and "slack", plus "pixels" and "pwm" under "output" when there's an
+    OutputThread.  Recording is safe from any thread.  Dumps happen from tick() on SIGUSR1 or every `interval`
+    seconds, so the printing never lands in the middle of a frame.
+    """
+
+    # slack goes negative on late frames, hence the first bucket
+    BUCKETS_MS = [float("-inf"), 0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, float("inf")]
+
+    def __init__(self, window=1024, interval=0.0):
+        self.window   = window
+        self.interval = interval
+        self.mode     = ""
+        self.samples  = {}
+        self.lock     = threading.Lock()
+
+        self.dump_requested = False
+        self.last_dump = time.monotonic()
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        def request_dump(signum, frame):
+            self.dump_requested = True
+        signal.signal(signum, request_dump)
+
+    def record(self, section, seconds, mode=None):
+        """Add a sample under `mode`, or the current mode if None."""
+        key = (self.mode if mode is None else mode, section)
+        with self.lock:
+            ring = self.samples.get(key)
+            if ring is None:
+                ring = self.samples[key] = [np.zeros(self.window), 0]
+            ring[0][ring[1] % self.window] = seconds
+            ring[1] += 1
+
+    def tick(self):
+        now = time.monotonic()
+        if self.dump_requested or (self.interval > 0.0 and now - self.last_dump >= self.interval):
+            self.dump()
+            self.dump_requested = False
+            self.last_dump = now
+
+    def dump(self, out=sys.stdout):
+        edges = self.BUCKETS_MS
+        print("---- profile (last %s samples, ms) ----" % self.window, file=out)
+        print("%-14s %-6s %8s %8s %8s %8s  %s" % ("mode", "sect", "mean", "p50", "p99", "max",
+            " ".join("<%g" % e for e in edges[1:-1]) + " more"), file=out)
+        with self.lock:
+            snapshot = [(key, ring[0][:min(ring[1], self.window)] * 1000.0) for key, ring in self.samples.items()]
+        for (mode, section), data in sorted(snapshot, key=lambda item: item[0]):
+            hist = np.histogram(data, edges)[0]
+            print("%-14s %-6s %8.3f %8.3f %8.3f %8.3f  %s" % (
+                mode, section,
+                data.mean(), np.percentile(data, 50), np.percentile(data, 99), data.max(),
+                " ".join(str(h) for h in hist),
+                ), file=out)
+
+class FrameScheduler(object):
+    """Paces frames against absolute deadlines on the clock (see Clock).
+
+    policy "drop" skips any deadlines we've already blown past, so a slow frame costs
+    frames rather than timing; "catchup" renders back to back until we're on schedule
+    again, up to max_catchup frames, and drops anything beyond that.
+    """
+
+    def __init__(self, policy="drop", max_catchup=4, clock=None):
+        self.policy      = policy
+        self.max_catchup = max_catchup
+        self.clock       = clock or frame_clock
+
+        self.fps      = None
+        self.period   = 0.0
+        self.deadline = 0.0
+
+        self.late_frames    = 0
+        self.dropped_frames = 0
+
+    def wait(self, fps):
+        now = self.clock.read()
+        if fps != self.fps:
+            # the mode (or its rate) changed; start a fresh timeline
+            self.fps      = fps
+            self.period   = 1.0 / fps
+            self.deadline = now
+
+        slack = self.deadline - now
+        if slack > 0.0:
+            self.clock.sleep(slack)
+        elif slack < 0.0:
+            self.late_frames += 1
+            behind = int(-slack / self.period)
+            if self.policy == "catchup":
+                behind = max(behind - self.max_catchup, 0)
+            self.dropped_frames += behind
+            self.deadline += behind * self.period
+
+        self.deadline += self.period
+        return slack
+
+class BeatPredictor(object):
+    """Puts visual beats on the music's beat instead of behind it.
+
+    observe() takes each detected beat (already stamped with when it happened in the
+    audio, see beat_detect_proc) and aubio's tempo, and fits a beat grid through the
+    recent ones.  due() then says when a frame should show a beat: at each grid point,
+    `latency` seconds early to cover the time from rendering to light.  While the grid
+    doesn't fit what we're hearing (too few beats, a tempo change, silence) confident()
+    is False and the caller should fall back to the detected beats.
+
+    Every observed beat is also scored against the grid it was predicted from, so
+    error() tells you how well this is working.
+    """
+
+    def __init__(self, latency=0.0, history=8):
+        self.latency = latency
+        self.history = history
+
+        self.beats  = []
+        self.period = 0.0
+        self.anchor = None
+        self.last_fired = float("-inf")
+
+        self.errors = []
+
+    def observe(self, beat_time, bpm):
+        if self.anchor is not None:
+            k = round((beat_time - self.anchor) / self.period)
+            self.errors.append(beat_time - (self.anchor + k * self.period))
+            del self.errors[:-4 * self.history]
+
+        if bpm > 0.0:
+            period = 60.0 / bpm
+            if abs(period - self.period) > 0.05 * period:
+                # new tempo; the old beats don't line up with it
+                self.beats = []
+            self.period = period
+        self.beats.append(beat_time)
+        del self.beats[:-self.history]
+
+        if self.period > 0.0:
+            # line every recent beat up with the newest one and average out the jitter
+            last = self.beats[-1]
+            self.anchor = sum(t + round((last - t) / self.period) * self.period for t in self.beats) / len(self.beats)
+
+    def confident(self, now):
+        if self.anchor is None or len(self.beats) < 3:
+            return False
+        if now - self.beats[-1] > 4.0 * self.period:
+            return False
+        recent = self.errors[-4:]
+        return len(recent) > 0 and sum(abs(e) for e in recent) / len(recent) < 0.1 * self.period
+
+    def due(self, now):
+        """True once for each predicted beat, on the first frame at or after its time."""
+        k = math.floor((now + self.latency - self.anchor) / self.period)
+        visual = self.anchor + k * self.period - self.latency
+        if visual > self.last_fired + self.period / 2.0:
+            self.last_fired = visual
+            # a beat we're well past (just locked on, or a long frame) is better skipped
+            return now - visual < self.period / 4.0
+        return False
+
+    def error(self):
+        """Mean and mean absolute prediction error over the recent beats, in seconds."""
+        if not self.errors:
+            return 0.0, 0.0
+        return sum(self.errors) / len(self.errors), sum(abs(e) for e in self.errors) / len(self.errors)
+
+class ModeSwitcher(object):
+    """Decides, beat by beat, when the music has changed enough to switch display modes:
+    a tempo change, a jump up or down in loudness against the last few beats, a long
+    stretch of silence, or just having been on one mode for too long.
+
+    The thresholds are plain attributes so they can be tuned, e.g. by running cached
+    beat grids through count_mode_changes().
+    """
+
+    def __init__(self, tempo_change=1.01, louder=2.0, quieter=5.0, silent_beats=32, max_beats=128, verbose=True):
+        self.tempo_change = tempo_change
+        self.louder       = louder
+        self.quieter      = quieter
+        self.silent_beats = silent_beats
+        self.max_beats    = max_beats
+        self.verbose      = verbose
+
+        self.beat_count = 0
+        self.running_beat_volume = []
+        self.max_beat_volume = 0.0
+        self.min_beat_volume = 0.0
+        self.is_quiet = False
+        self.prev_tempo_bpm = 0.0
+
+    def beat(self, tempo_bpm, peak_volume, volume):
+        """Count one beat; returns True if the mode should change on it."""
+        beat_count = self.beat_count
+        verbose = self.verbose
+
+        changing = False
+        tempo_diff    = (max(tempo_bpm,self.prev_tempo_bpm) + 0.0001) / (min(tempo_bpm, self.prev_tempo_bpm) + 0.0001)
+        max_peak_diff = (peak_volume + 0.0001)                        / (self.max_beat_volume + 0.0001)
+        min_peak_diff = (self.min_beat_volume + 0.0001)               / (peak_volume + 0.0001)
+
+        if verbose:
+            print(" ** beat %s @%s - td %s, maxpd %s, minpd %s" % (
+                beat_count,
+                "{:.6f}".format(tempo_bpm),
+                "{:.6f}".format(tempo_diff),
+                "{:.6f}".format(max_peak_diff),
+                "{:.6f}".format(min_peak_diff),
+                ))
+
+        if beat_count >= 2 and tempo_diff > self.tempo_change:
+            if verbose:
+                print("%s: t %s != %s (%s)" % (beat_count, "{:.2f}".format(tempo_bpm), "{:.2f}".format(self.prev_tempo_bpm), "{:.2f}".format(tempo_diff)))
+            changing = True
+        elif beat_count >= 2 and max_peak_diff > self.louder:
+            if verbose:
+                print("%s: %s > %s (%s)" % (beat_count, "{:.6f}".format(peak_volume), "{:.6f}".format(self.max_beat_volume), "{:.2f}".format(max_peak_diff)))
+            changing = True
+            self.is_quiet = False
+        elif beat_count >= 4 and min_peak_diff > self.quieter:
+            if verbose:
+                print("%s: %s < %s (%s)" % (beat_count, "{:.6f}".format(peak_volume), "{:.6f}".format(self.min_beat_volume), "{:.2f}".format(min_peak_diff)))
+            self.is_quiet = True
+            changing = True
+        elif volume < 0.00001 and beat_count == self.silent_beats:
+            if verbose:
+                print("%s beats" % self.silent_beats)
+            changing = True
+        elif beat_count == self.max_beats:
+            if verbose:
+                print("%s beats" % self.max_beats)
+            changing = True
+        if changing:
+            self.beat_count = 0
+
+        self.running_beat_volume.append(peak_volume)
+        if len(self.running_beat_volume) > 4:
+            del self.running_beat_volume[0]
+
+        self.max_beat_volume = max(self.running_beat_volume)
+        self.min_beat_volume = min(self.running_beat_volume)
+
+        self.prev_tempo_bpm = tempo_bpm
+
+        self.beat_count += 1
+        return changing
+
+class Palette(object):
+    """A palette, compiled once into an array of HSL rows.
+
+    random_hue palettes are hue templates: every time one is picked, a random hue is
+    added to all of its colors.  generate is for palettes whose shape is random too; it
+    gets called on every pick for a fresh list of HSL colors.
+    """
+
+    def __init__(self, colors=None, random_hue=False, generate=None):
+        self.hsl = None
+        if colors is not None:
+            self.hsl = np.array(colors, dtype=float)
+            self.hsl.flags.writeable = False
+        self.random_hue = random_hue
+        self.generate   = generate
+        self.compiled   = None
+
+    def make(self):
+        """The arrays for one pick of this palette: (hsl, rgb, packed, hex_rgb).
+        Palettes with nothing random share one read-only copy."""
+        if self.generate:
+            return palette_arrays(np.array(self.generate(), dtype=float))
+        if self.random_hue:
+            hsl = self.hsl.copy()
+            hsl[:,0] += random.random()
+            return palette_arrays(hsl)
+        if self.compiled is None:
+            self.compiled = palette_arrays(self.hsl)
+            for a in self.compiled:
+                a.flags.writeable = False
+        return self.compiled
+
+def palette_arrays(hsl):
+    """Everything a frame needs from a palette, converted once per pick instead of once per pixel."""
+    rgb = hsl_to_rgb_array(hsl)
+
+    # the hexagons get dim colors brightened so they don't just go dark
+    hex_hsl = hsl.copy()
+    hex_hsl[hex_hsl[:,2] < 0.25, 2] += 0.5
+    return hsl, rgb, pack_rgb(rgb), hsl_to_rgb_array(hex_hsl)
+
+def rainbow_snake():
+    x = random.random()
+    z = random.choice([2,3,4,1000])
+    return [[x + y * 0.005, 1.0, (max(0.6 - y * 0.005, 0.0) if y % z != 0 else 0.0)] for y in range(175)]
+
+PALETTES = {
+    # HSL values
+
+#    "rainbow": [
+#        [0.0,       1.0, 0.5], # red
+#        [0.035, 1.0, 0.5], # orange
+#        [0.09, 1.0, 0.5], # yellow
+#        [0.333333333333333, 1.0, 0.5], # green
+#        [0.6, 1.0, 0.5], # blue
+#        [0.72, 1.0, 0.5], # indigo
+#        [0.8,      1.0, 0.4], # violet
+#    ],
+#    "experiment": lambda: list(map(lambda x: [20.0/max(x % 20,0.0001), 1.0, random.choice([random.random() * 0.5, 0.0])], range(100))),
+    "rainbow snake": Palette(generate=rainbow_snake),
+    "30 degree quad": Palette([
+        [0.0, 1.0, 0.05],
+        [0.0, 1.0, 0.1],
+        [0.0, 1.0, 0.25],
+        [0.0, 1.0, 0.5],
+        [0.0, 1.0, 0.75],
+        [0.0, 1.0, 0.5],
+        [0.0, 1.0, 0.25],
+        [0.0, 1.0, 0.1],
+        [0.0, 1.0, 0.05],
+
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+
+        [0.0833333, 1.0, 0.25],
+        [0.0833333, 1.0, 0.25],
+
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+
+        [0.5, 1.0, 0.0625],
+        [0.5, 1.0, 0.125],
+        [0.5, 1.0, 0.25],
+        [0.5, 1.0, 0.125],
+        [0.5, 1.0, 0.0625],
+
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+
+        [0.0833333, 1.0, 0.25],
+        [0.0833333, 1.0, 0.25],
+
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+    ], random_hue=True),
+    "quad bubbles": Palette([
+        [0.0,1.0,0.0625],
+        [0.0,1.0,0.125],
+        [0.0,1.0,0.25],
+        [0.0,1.0,0.5],
+        [0.0,1.0,0.75],
+        [0.0,1.0,0.5],
+        [0.0,1.0,0.25],
+        [0.0,1.0,0.125],
+        [0.0,1.0,0.0625],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.25,0.25,0.133333],
+        [0.25,0.25,0.25],
+        [0.25,0.25,0.133333],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.5,0.5,0.0625],
+        [0.5,0.5,0.125],
+        [0.5,0.5,0.25],
+        [0.5,0.5,0.5],
+        [0.5,0.5,0.75],
+        [0.5,0.5,0.5],
+        [0.5,0.5,0.25],
+        [0.5,0.5,0.125],
+        [0.5,0.5,0.0625],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.75,0.25,0.133333],
+        [0.75,0.25,0.25],
+        [0.75,0.25,0.133333],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+        [0.0,0.0,0.0],
+    ], random_hue=True),
+    "mermaid": Palette([
+        [0.5,  1.0, 0.03125],
+        [0.66, 1.0, 0.03125],
+        [0.7,  1.0, 0.03125],
+        [0.66, 1.0, 0.03125],
+        [0.5,  1.0, 0.0625],
+        [0.66, 1.0, 0.0625],
+        [0.7,  1.0, 0.0625],
+        [0.66, 1.0, 0.0625],
+        [0.5,  1.0, 0.125],
+        [0.66, 1.0, 0.125],
+        [0.7,  1.0, 0.125],
+        [0.66, 1.0, 0.125],
+        [0.5,  1.0, 0.25],
+        [0.66, 1.0, 0.25],
+        [0.7,  1.0, 0.25],
+        [0.66, 1.0, 0.25],
+        [0.5,  1.0, 0.5],
+        [0.66, 1.0, 0.5],
+        [0.7,  1.0, 0.5],
+        [0.66, 1.0, 0.5],
+        [0.5,  1.0, 0.25],
+        [0.66, 1.0, 0.25],
+        [0.7,  1.0, 0.25],
+        [0.66, 1.0, 0.25],
+        [0.5,  1.0, 0.125],
+        [0.66, 1.0, 0.125],
+        [0.7,  1.0, 0.125],
+        [0.66, 1.0, 0.125],
+        [0.5,  1.0, 0.0625],
+        [0.66, 1.0, 0.0625],
+        [0.7,  1.0, 0.0625],
+        [0.66, 1.0, 0.0625],
+    ]),
+    "lava": Palette([
+        [0.0,    1.0, 0.5],
+        [0.0,    1.0, 0.125],
+        [0.0,    1.0, 0.05],
+        [0.0,    1.0, 0.025],
+        [0.0, 0.0, 0.0], # black
+        [0.09,  1.0, 0.5], # yellow
+        [0.09,  1.0, 0.66], # yellow
+        [0.04, 1.0, 0.5], # orange
+    ]),
+    "lori": Palette([
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+
+        [0.75,    1.0, 0.125],
+        [0.75,    1.0, 0.0625],
+        [0.0,    1.0, 0.1333],
+        [0.0,    1.0, 0.125],
+        [0.0,    1.0, 0.0625],
+        [0.66,    1.0, 0.15],
+
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+
+        [0.75,    1.0, 0.5],
+        [0.75,    1.0, 0.25],
+        [0.0,    1.0, 0.66],
+        [0.0,    1.0, 0.5],
+        [0.0,    1.0, 0.25],
+        [0.66,    1.0, 0.75],
+
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+
+        [0.75,    1.0, 0.25],
+        [0.75,    1.0, 0.125],
+        [0.0,    1.0, 0.33],
+        [0.0,    1.0, 0.25],
+        [0.0,    1.0, 0.125],
+        [0.66,    1.0, 0.375],
+
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+
+        [0.75,    1.0, 0.5],
+        [0.75,    1.0, 0.25],
+        [0.0,    1.0, 0.66],
+        [0.0,    1.0, 0.5],
+        [0.0,    1.0, 0.25],
+        [0.66,    1.0, 0.75],
+    ]),
+    "starfield": Palette([
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.1666666, 1.0, 0.7], # yellow
+        [0.1666666, 0.0, 0.75], # white
+        [0.6666666, 1.0, 0.7], # blue
+        [0.0, 0.0, 0.0], # black
+        [0.6666666, 1.0, 0.2], # blue
+    ]),
+    "blue and green": Palette([
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.6666666, 1.0, 0.5], # blue
+        [0.6666666, 1.0, 0.25], # blue
+        [0.6666666, 1.0, 0.0125], # blue
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.3333333, 1.0, 0.5], # green
+        [0.3333333, 1.0, 0.125], # green
+        [0.3333333, 1.0, 0.05], # green
+    ]),
+    "candy cane": Palette([
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 1.0, 0.05], # dark red
+        [0.0, 1.0, 0.5], # red
+        [0.0, 0.0, 1.0], # white
+        [0.0, 0.0, 0.05], # gray
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+    ]),
+    "protons": Palette([
+        # powder blue 15%
+        [0.6666666, 1.0, 0.66], # powder blue
+        [0.6666666, 1.0, 0.5], # powder blue
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        # white 15%
+        [0.6666666, 1.0, 1.0], # white
+        [0.6666666, 1.0, 1.0], # white
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+    ]),
+    "megarainbow": Palette([
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0,       1.0, 0.5], # red
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.035, 1.0, 0.5], # orange
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.09, 1.0, 0.5], # yellow
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.333333333333333, 1.0, 0.5], # green
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.6, 1.0, 0.5], # blue
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.72, 1.0, 0.5], # indigo
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.0, 0.0, 0.0], # black
+        [0.8,      1.0, 0.4], # violet
+    ]),
+    "night sky": Palette([
+        [0.16666, 1.0, 0.2], # yellow
+        [0.16666, 1.0, 0.75], # yellow
+        [0.16666, 1.0, 0.2], # yellow
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.64, 1.0, 0.0125], # blue
+        [0.65, 1.0, 0.025], # blue
+        [0.66, 1.0, 0.05], # blue
+        [0.67, 1.0, 0.1], # blue
+        [0.68, 1.0, 0.2], # blue
+        [0.69, 1.0, 0.3], # blue
+        [0.70, 1.0, 0.4], # blue
+        [0.71, 1.0, 0.5], # blue
+        [0.70, 1.0, 0.4], # blue
+        [0.69, 1.0, 0.3], # blue
+        [0.68, 1.0, 0.2], # blue
+        [0.67, 1.0, 0.1], # blue
+        [0.66, 1.0, 0.05], # blue
+        [0.65, 1.0, 0.025], # blue
+        [0.64, 1.0, 0.0125], # blue
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.0, 1.0, 0.2], # red
+        [0.0, 1.0, 0.75], # red
+        [0.0, 1.0, 0.2], # red
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.64, 1.0, 0.0125], # blue
+        [0.65, 1.0, 0.025], # blue
+        [0.66, 1.0, 0.05], # blue
+        [0.67, 1.0, 0.1], # blue
+        [0.68, 1.0, 0.2], # blue
+        [0.69, 1.0, 0.3], # blue
+        [0.70, 1.0, 0.4], # blue
+        [0.71, 1.0, 0.5], # blue
+        [0.70, 1.0, 0.4], # blue
+        [0.69, 1.0, 0.3], # blue
+        [0.68, 1.0, 0.2], # blue
+        [0.67, 1.0, 0.1], # blue
+        [0.66, 1.0, 0.05], # blue
+        [0.65, 1.0, 0.025], # blue
+        [0.64, 1.0, 0.0125], # blue
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+    ]),
+    "red and black": Palette([
+        [0.0, 1.0, 0.0125], # red
+        [0.0, 1.0, 0.5], # red
+        [0.0, 1.0, 0.5], # red
+        [0.0, 1.0, 0.0125], # red
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+    ]),
+    "primary male": Palette([
+        [0.0, 1.0, 0.5], # red
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.0, 1.0, 0.5], # red
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.0, 1.0, 0.5], # red
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.09, 1.0, 0.5], # yellow
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.09, 1.0, 0.5], # yellow
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.09, 1.0, 0.5], # yellow
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.6, 1.0, 0.5], # blue
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.6, 1.0, 0.5], # blue
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.6, 1.0, 0.5], # blue
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+        [0.62, 1.0, 0.0], # black
+    ]),
+    "movie poster": Palette([
+        [0.7125,  1.0, 0.05], # violet
+        [0.7125,  1.0, 0.15], # violet
+        [0.7125,  1.0, 0.25], # violet
+        [0.7125,  1.0, 0.35], # violet
+        [0.7125,  1.0, 0.45], # violet
+        [0.7125,  1.0, 0.5], # violet
+        [0.07,    1.0, 0.5], # orange
+        [0.075,   1.0, 0.4], # orange
+        [0.08,    1.0, 0.3], # orange
+        [0.085,   1.0, 0.2], # orange
+        [0.09,    1.0, 0.1], # orange
+        [0.09,    1.0, 0.1], # orange
+        [0.085,   1.0, 0.2], # orange
+        [0.08,    1.0, 0.3], # orange
+        [0.075,   1.0, 0.4], # orange
+        [0.07,    1.0, 0.5], # orange
+        [0.7125,  1.0, 0.45], # violet
+        [0.7125,  1.0, 0.35], # violet
+        [0.7125,  1.0, 0.25], # violet
+        [0.7125,  1.0, 0.15], # violet
+        [0.7125,  1.0, 0.05], # violet
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+    ]),
+#    "yellowblue": lambda: [
+#        [0.6666666, 1.0, 1.0], # blue
+#        [0.6666666, 1.0, 0.7], # blue
+#        [0.1666666, 1.0, 0.5], # yellow
+#        [0.1666666, 1.0, 0.25], # yellow
+#    ],
+    "pinot noir": Palette([
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.055, 1.0, 0.0625], # brown
+        [0.055, 1.0, 0.0625], # brown
+        [0.055, 1.0, 0.0625], # brown
+        [0.0, 1.0, 0.125], # red
+        [0.0, 1.0, 0.25], # red
+        [0.0, 1.0, 0.5], # red
+        [0.0, 1.0, 0.25], # red
+        [0.0, 1.0, 0.125], # red
+        [0.95,  1.0, 0.125], # violet
+        [0.95,  1.0, 0.25], # violet
+        [0.95,  1.0, 0.5], # violet
+        [0.95,  1.0, 0.25], # violet
+        [0.95,  1.0, 0.125], # violet
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+        [0.0, 1.0, 0.0], # black
+    ]),
+}
+
+def load_palette_file(path):
+    """Palettes and per-mode parameters from a JSON file like
+
+        {"palettes": {"name": [[h, s, l], ...],
+                      "name": {"colors": [[h, s, l], ...], "random_hue": true},
+                      "built-in palette to drop": null},
+         "modes": {"Shift": {"fps": [10, 20, 30], "palettes": ["lava", "mermaid"]}}}
+
+    File palettes go on top of the built-in ones.  Mode parameters are keyed by class
+    name; see DisplayMode.param().  Returns (palettes, mode parameters).
+    """
+    with open(path) as f:
+        data = json.load(f)
+    # check everything before returning anything, so a bad file can't leave the modes
+    # half updated (or crash them later)
+    if not isinstance(data, dict):
+        raise ValueError("expected an object at the top level")
+    specs = data.get("palettes", {})
+    modes = data.get("modes", {})
+    if not isinstance(specs, dict) or not isinstance(modes, dict):
+        raise ValueError("\"palettes\" and \"modes\" have to be objects")
+
+    palettes = dict(PALETTES)
+    for name, spec in specs.items():
+        if spec is None:
+            palettes.pop(name, None)
+            continue
+        random_hue = False
+        if isinstance(spec, dict):
+            random_hue = spec.get("random_hue", False)
+            spec = spec.get("colors")
+        if not isinstance(spec, list) or not isinstance(random_hue, bool):
+            raise ValueError("palette %s isn't a list of [h, s, l] colors" % name)
+        palette = Palette(spec, random_hue=random_hue)
+        if palette.hsl.ndim != 2 or palette.hsl.shape[1] != 3 or len(palette.hsl) == 0 \
+                or not np.isfinite(palette.hsl).all():
+            raise ValueError("palette %s isn't a list of [h, s, l] colors" % name)
+        # the modes that want a lit color keep picking until they get one
+        if not (palette.hsl[:,2] > 1e-5).any():
+            raise ValueError("palette %s has no color that isn't black" % name)
+        palettes[name] = palette
+    if not palettes:
+        raise ValueError("no palettes left")
+
+    for mode, params in modes.items():
+        if not isinstance(params, dict):
+            raise ValueError("parameters for %s have to be an object" % mode)
+        for key, value in params.items():
+            check_mode_param(mode, key, value)
+
+    return palettes, modes
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+# what each mode parameter in a palette file may be set to; a list of these is fine too
+MODE_PARAMS = {
+    "fps":       lambda v: _is_number(v) and v > 0,
+    "chance":    lambda v: _is_number(v) and 0 <= v <= 1,
+    "max_stars": lambda v: isinstance(v, int) and not isinstance(v, bool) and v >= 0,
+}
+
+def check_mode_param(mode, key, value):
+    if key == "palettes":
+        if not isinstance(value, list) or not all(isinstance(n, str) for n in value):
+            raise ValueError("%s.palettes has to be a list of palette names" % mode)
+        return
+    if key not in MODE_PARAMS:
+        raise ValueError("%s.%s isn't a mode parameter" % (mode, key))
+    choices = value if isinstance(value, list) else [value]
+    if not choices or not all(MODE_PARAMS[key](v) for v in choices):
+        raise ValueError("bad value for %s.%s: %r" % (mode, key, value))
+
+class PaletteWatcher(object):
+    """Reloads a palette file into the running modes whenever it changes.  poll() goes
+    between frames; it looks at the file's mtime at most every `interval` seconds, and
+    a file that won't load leaves the current palettes alone."""
+
+    def __init__(self, path, modes, interval=1.0):
+        self.path = path
+        self.modes = modes
+        self.interval = interval
+
+        self.mtime = None
+        self.last_poll = float("-inf")
+
+    def poll(self, now):
+        if now - self.last_poll < self.interval:
+            return False
+        self.last_poll = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            palettes, params = load_palette_file(self.path)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, IndexError) as e:
+            print("Not loading palettes from %s: %s" % (self.path, e))
+            return False
+
+        for mode in self.modes:
+            mode.set_palettes(palettes, params.get(type(mode).__name__))
+        print("Loaded %d palettes from %s" % (len(palettes), self.path))
+        return True
+
 class DisplayMode(object):
-    def __init__(self, strip, hx, clear=True):
+    def __init__(self, strip, hx, clear=True, clock=None):
         self.hx = hx
         self.strip = strip
-        self.length = LED_COUNT
+        self.clock = clock or frame_clock
+        self.length = strip.length
+
+        # modes render HSL into this, and go_wrap converts the whole thing once per frame
+        self.hslbuf = np.zeros((self.length, 3))
+        self.frame  = np.zeros(self.length, dtype=np.uint32)
+        self.hsl_dirty = False
+        self.pixels_written = 0
 
-        self.last_loud = time.time()
+        self.last_loud = self.clock.now
         self.quiet_vol = 0.0
         self.loud_vol = 0.0
         self.is_quiet = False
 
         if clear:
-            for i in range(0, self.strip.numPixels()):
-                self.strip.setPixelColor(i, Color(0,0,0))
-
-        self.palettes = {
-            # HSL values
-
-#            "rainbow": [
-#                [0.0,       1.0, 0.5], # red
-#                [0.035, 1.0, 0.5], # orange
-#                [0.09, 1.0, 0.5], # yellow
-#                [0.333333333333333, 1.0, 0.5], # green
-#                [0.6, 1.0, 0.5], # blue
-#                [0.72, 1.0, 0.5], # indigo
-#                [0.8,      1.0, 0.4], # violet
-#            ],
-#            "experiment": lambda: list(map(lambda x: [20.0/max(x % 20,0.0001), 1.0, random.choice([random.random() * 0.5, 0.0])], range(100))),
-            "rainbow snake": lambda x=random.random(), z=random.choice([2,3,4,1000]): list(map( lambda y: [x + y * 0.005,1.0,(max(0.6 - y * 0.005, 0.0) if y % z != 0 else 0.0)], range(175) )),
-            "30 degree quad": lambda x=random.random(): [
-                [x, 1.0, 0.05],
-                [x, 1.0, 0.1],
-                [x, 1.0, 0.25],
-                [x, 1.0, 0.5],
-                [x, 1.0, 0.75],
-                [x, 1.0, 0.5],
-                [x, 1.0, 0.25],
-                [x, 1.0, 0.1],
-                [x, 1.0, 0.05],
-
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-
-                [x + 0.0833333, 1.0, 0.25],
-                [x + 0.0833333, 1.0, 0.25],
-
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-
-                [x + 0.5, 1.0, 0.0625],
-                [x + 0.5, 1.0, 0.125],
-                [x + 0.5, 1.0, 0.25],
-                [x + 0.5, 1.0, 0.125],
-                [x + 0.5, 1.0, 0.0625],
-
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-
-                [x + 0.0833333, 1.0, 0.25],
-                [x + 0.0833333, 1.0, 0.25],
-
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-            ],
-            "quad bubbles": lambda x=random.random(): [
-                [x,1.0,0.0625],
-                [x,1.0,0.125],
-                [x,1.0,0.25],
-                [x,1.0,0.5],
-                [x,1.0,0.75],
-                [x,1.0,0.5],
-                [x,1.0,0.25],
-                [x,1.0,0.125],
-                [x,1.0,0.0625],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [x + 0.25,0.25,0.133333],
-                [x + 0.25,0.25,0.25],
-                [x + 0.25,0.25,0.133333],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [x + 0.5,0.5,0.0625],
-                [x + 0.5,0.5,0.125],
-                [x + 0.5,0.5,0.25],
-                [x + 0.5,0.5,0.5],
-                [x + 0.5,0.5,0.75],
-                [x + 0.5,0.5,0.5],
-                [x + 0.5,0.5,0.25],
-                [x + 0.5,0.5,0.125],
-                [x + 0.5,0.5,0.0625],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [x + 0.75,0.25,0.133333],
-                [x + 0.75,0.25,0.25],
-                [x + 0.75,0.25,0.133333],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-                [0.0,0.0,0.0],
-            ],
-            "mermaid": lambda: [
-                [0.5,  1.0, 0.03125],
-                [0.66, 1.0, 0.03125],
-                [0.7,  1.0, 0.03125],
-                [0.66, 1.0, 0.03125],
-                [0.5,  1.0, 0.0625],
-                [0.66, 1.0, 0.0625],
-                [0.7,  1.0, 0.0625],
-                [0.66, 1.0, 0.0625],
-                [0.5,  1.0, 0.125],
-                [0.66, 1.0, 0.125],
-                [0.7,  1.0, 0.125],
-                [0.66, 1.0, 0.125],
-                [0.5,  1.0, 0.25],
-                [0.66, 1.0, 0.25],
-                [0.7,  1.0, 0.25],
-                [0.66, 1.0, 0.25],
-                [0.5,  1.0, 0.5],
-                [0.66, 1.0, 0.5],
-                [0.7,  1.0, 0.5],
-                [0.66, 1.0, 0.5],
-                [0.5,  1.0, 0.25],
-                [0.66, 1.0, 0.25],
-                [0.7,  1.0, 0.25],
-                [0.66, 1.0, 0.25],
-                [0.5,  1.0, 0.125],
-                [0.66, 1.0, 0.125],
-                [0.7,  1.0, 0.125],
-                [0.66, 1.0, 0.125],
-                [0.5,  1.0, 0.0625],
-                [0.66, 1.0, 0.0625],
-                [0.7,  1.0, 0.0625],
-                [0.66, 1.0, 0.0625],
-            ],
-            "lava": lambda: [
-                [0.0,    1.0, 0.5],
-                [0.0,    1.0, 0.125],
-                [0.0,    1.0, 0.05],
-                [0.0,    1.0, 0.025],
-                [0.0, 0.0, 0.0], # black
-                [0.09,  1.0, 0.5], # yellow
-                [0.09,  1.0, 0.66], # yellow
-                [0.04, 1.0, 0.5], # orange
-            ],
-            "lori": lambda: [
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-
-                [0.75,    1.0, 0.125],
-                [0.75,    1.0, 0.0625],
-                [0.0,    1.0, 0.1333],
-                [0.0,    1.0, 0.125],
-                [0.0,    1.0, 0.0625],
-                [0.66,    1.0, 0.15],
-
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-
-                [0.75,    1.0, 0.5],
-                [0.75,    1.0, 0.25],
-                [0.0,    1.0, 0.66],
-                [0.0,    1.0, 0.5],
-                [0.0,    1.0, 0.25],
-                [0.66,    1.0, 0.75],
-
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-
-                [0.75,    1.0, 0.25],
-                [0.75,    1.0, 0.125],
-                [0.0,    1.0, 0.33],
-                [0.0,    1.0, 0.25],
-                [0.0,    1.0, 0.125],
-                [0.66,    1.0, 0.375],
-
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-
-                [0.75,    1.0, 0.5],
-                [0.75,    1.0, 0.25],
-                [0.0,    1.0, 0.66],
-                [0.0,    1.0, 0.5],
-                [0.0,    1.0, 0.25],
-                [0.66,    1.0, 0.75],
-            ],
-            "starfield": lambda: [
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.1666666, 1.0, 0.7], # yellow
-                [0.1666666, 0.0, 0.75], # white
-                [0.6666666, 1.0, 0.7], # blue
-                [0.0, 0.0, 0.0], # black
-                [0.6666666, 1.0, 0.2], # blue
-            ],
-            "blue and green": lambda: [
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.6666666, 1.0, 0.5], # blue
-                [0.6666666, 1.0, 0.25], # blue
-                [0.6666666, 1.0, 0.0125], # blue
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.3333333, 1.0, 0.5], # green
-                [0.3333333, 1.0, 0.125], # green
-                [0.3333333, 1.0, 0.05], # green
-            ],
-            "candy cane": lambda: [
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 1.0, 0.05], # dark red
-                [0.0, 1.0, 0.5], # red
-                [0.0, 0.0, 1.0], # white
-                [0.0, 0.0, 0.05], # gray
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-            ],
-            "protons": lambda: [
-                # powder blue 15%
-                [0.6666666, 1.0, 0.66], # powder blue
-                [0.6666666, 1.0, 0.5], # powder blue
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                # white 15%
-                [0.6666666, 1.0, 1.0], # white
-                [0.6666666, 1.0, 1.0], # white
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-            ],
-            "megarainbow": lambda: [
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0,       1.0, 0.5], # red
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.035, 1.0, 0.5], # orange
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.09, 1.0, 0.5], # yellow
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.333333333333333, 1.0, 0.5], # green
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.6, 1.0, 0.5], # blue
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.72, 1.0, 0.5], # indigo
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.0, 0.0, 0.0], # black
-                [0.8,      1.0, 0.4], # violet
-            ],
-            "night sky": lambda: [
-                [0.16666, 1.0, 0.2], # yellow
-                [0.16666, 1.0, 0.75], # yellow
-                [0.16666, 1.0, 0.2], # yellow
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.64, 1.0, 0.0125], # blue
-                [0.65, 1.0, 0.025], # blue
-                [0.66, 1.0, 0.05], # blue
-                [0.67, 1.0, 0.1], # blue
-                [0.68, 1.0, 0.2], # blue
-                [0.69, 1.0, 0.3], # blue
-                [0.70, 1.0, 0.4], # blue
-                [0.71, 1.0, 0.5], # blue
-                [0.70, 1.0, 0.4], # blue
-                [0.69, 1.0, 0.3], # blue
-                [0.68, 1.0, 0.2], # blue
-                [0.67, 1.0, 0.1], # blue
-                [0.66, 1.0, 0.05], # blue
-                [0.65, 1.0, 0.025], # blue
-                [0.64, 1.0, 0.0125], # blue
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.0, 1.0, 0.2], # red
-                [0.0, 1.0, 0.75], # red
-                [0.0, 1.0, 0.2], # red
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.64, 1.0, 0.0125], # blue
-                [0.65, 1.0, 0.025], # blue
-                [0.66, 1.0, 0.05], # blue
-                [0.67, 1.0, 0.1], # blue
-                [0.68, 1.0, 0.2], # blue
-                [0.69, 1.0, 0.3], # blue
-                [0.70, 1.0, 0.4], # blue
-                [0.71, 1.0, 0.5], # blue
-                [0.70, 1.0, 0.4], # blue
-                [0.69, 1.0, 0.3], # blue
-                [0.68, 1.0, 0.2], # blue
-                [0.67, 1.0, 0.1], # blue
-                [0.66, 1.0, 0.05], # blue
-                [0.65, 1.0, 0.025], # blue
-                [0.64, 1.0, 0.0125], # blue
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-            ],
-            "red and black": lambda: [
-                [0.0, 1.0, 0.0125], # red
-                [0.0, 1.0, 0.5], # red
-                [0.0, 1.0, 0.5], # red
-                [0.0, 1.0, 0.0125], # red
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-            ],
-            "primary male": lambda: [
-                [0.0, 1.0, 0.5], # red
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.0, 1.0, 0.5], # red
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.0, 1.0, 0.5], # red
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.09, 1.0, 0.5], # yellow
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.09, 1.0, 0.5], # yellow
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.09, 1.0, 0.5], # yellow
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.6, 1.0, 0.5], # blue
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.6, 1.0, 0.5], # blue
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.6, 1.0, 0.5], # blue
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-                [0.62, 1.0, 0.0], # black
-            ],
-            "movie poster": lambda: [
-                [0.7125,  1.0, 0.05], # violet
-                [0.7125,  1.0, 0.15], # violet
-                [0.7125,  1.0, 0.25], # violet
-                [0.7125,  1.0, 0.35], # violet
-                [0.7125,  1.0, 0.45], # violet
-                [0.7125,  1.0, 0.5], # violet
-                [0.07,    1.0, 0.5], # orange
-                [0.075,   1.0, 0.4], # orange
-                [0.08,    1.0, 0.3], # orange
-                [0.085,   1.0, 0.2], # orange
-                [0.09,    1.0, 0.1], # orange
-                [0.09,    1.0, 0.1], # orange
-                [0.085,   1.0, 0.2], # orange
-                [0.08,    1.0, 0.3], # orange
-                [0.075,   1.0, 0.4], # orange
-                [0.07,    1.0, 0.5], # orange
-                [0.7125,  1.0, 0.45], # violet
-                [0.7125,  1.0, 0.35], # violet
-                [0.7125,  1.0, 0.25], # violet
-                [0.7125,  1.0, 0.15], # violet
-                [0.7125,  1.0, 0.05], # violet
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-            ],
-#            "yellowblue": lambda: [
-#                [0.6666666, 1.0, 1.0], # blue
-#                [0.6666666, 1.0, 0.7], # blue
-#                [0.1666666, 1.0, 0.5], # yellow
-#                [0.1666666, 1.0, 0.25], # yellow
-#            ],
-            "pinot noir": lambda: [
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.055, 1.0, 0.0625], # brown
-                [0.055, 1.0, 0.0625], # brown
-                [0.055, 1.0, 0.0625], # brown
-                [0.0, 1.0, 0.125], # red
-                [0.0, 1.0, 0.25], # red
-                [0.0, 1.0, 0.5], # red
-                [0.0, 1.0, 0.25], # red
-                [0.0, 1.0, 0.125], # red
-                [0.95,  1.0, 0.125], # violet
-                [0.95,  1.0, 0.25], # violet
-                [0.95,  1.0, 0.5], # violet
-                [0.95,  1.0, 0.25], # violet
-                [0.95,  1.0, 0.125], # violet
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-                [0.0, 1.0, 0.0], # black
-            ],
-        }
+            self.strip.write_frame(self.frame)
+
+        self.palettes = PALETTES
+        self.params   = {}
 
         self.fps          = 60
         self.frame_count  = 0
@@ -721,8 +1634,11 @@ class DisplayMode(object):
 
         self.beat_count = 0
 
+        # latest per-band audio energies (see AUDIO_BANDS), for modes that want them
+        self.bands = np.zeros(0)
+
         self.last_beat_duration = 0.25 # arbitrary init value
-        self.last_exec = time.time()
+        self.last_exec = self.clock.now
         self.last_subbeat = -1
 
         self.saved_palette_name = ""
@@ -730,46 +1646,50 @@ class DisplayMode(object):
 
         self.reset()
 
-    def go_wrap(self, is_beat=False, volume=0.0):
-        start_time = time.time()
-
-        # FIXME: we should only set the color of an led when it changes, to save bandwidth for longer strands.
+    def go_wrap(self, is_beat=False, volume=0.0, bands=None):
+        start_time = self.clock.now
 
         # if the sub beat we're on changes
         self.subbeat = int((start_time - self.last_beat) / (self.last_beat_duration / 8))
         self.is_subbeat = self.subbeat != self.last_subbeat
         if is_beat:
-            self.last_beat = time.time()
+            self.last_beat = start_time
 
-        if time.time() - self.last_beat > 2.0:
+        if start_time - self.last_beat > 2.0:
             self.no_beat = True
         else:
             self.no_beat = False
 
+        if profiler:
+            profiler.mode = type(self).__name__
+        t0 = time.perf_counter()
+        if bands is not None:
+            self.bands = bands
         self.go(is_beat, volume)
+        if profiler:
+            profiler.record("go", time.perf_counter() - t0)
+        self.show()
 
         self.last_subbeat = self.subbeat
         self.frame_count += 1
-        finish_time = time.time()
-        sleep_time = max((1.0 / self.fps) - (finish_time - start_time), 0.0)
-        time.sleep(sleep_time)
 
     def get_palette(self):
         if self.saved_palette_name != self.palette:
-            self.saved_palette = []
-            for color in self.palettes[self.palette]():
-                self.saved_palette.append([color[0],color[1],color[2]])
-            self.saved_palette_name = self.palette
+            self.compile_palette()
         return self.saved_palette
 
-    def set_pixel_hsl(self, pixnum, hsl):
+    def show(self):
+        t0 = time.perf_counter()
+        if self.hsl_dirty:
+            self.frame[:] = pack_rgb(hsl_to_rgb_array(self.hslbuf))
+            self.hsl_dirty = False
+        t1 = time.perf_counter()
+        if profiler:
+            profiler.record("hsl", t1 - t0)
 
-        c = colorsys.hls_to_rgb(hsl[0],hsl[2],hsl[1])
-        self.strip.setPixelColor(pixnum, Color(
-            int(c[0] * 255),
-            int(c[1] * 255),
-            int(c[2] * 255),
-        ))
+        self.pixels_written = self.strip.write_frame(self.frame)
+        if profiler:
+            profiler.record("show", time.perf_counter() - t1)
 
     def get_nonblack_color(self):
         color = [0.0,0.0,0.0]
@@ -778,13 +1698,14 @@ class DisplayMode(object):
         return color
 
     def flip_hex_colors(self):
-        adjacent_color = hx[0].get_hsl()
-        for i in range(len(hx)):
-            h = hx[i]
+        adjacent_color = self.hx[0].get_hsl()
+        for i in range(len(self.hx)):
+            h = self.hx[i]
             oldcolor = h.get_hsl()
-            color_list = self.get_palette().copy()
+            color_list = list(range(len(self.palette_hsl)))
             random.shuffle(color_list)
-            hxhsl = color_list[0].copy()
+            hxhsl = self.palette_hsl[color_list[0]]
+            hxcolor = self.palette_hex_rgb[color_list[0]]
             while cmp_color(hxhsl,oldcolor, 0.1) or cmp_color(hxhsl, adjacent_color, 0.1) or float_close(hxhsl[2], 0.0):
                 if len(color_list) == 1:
                     hxhsl = adjacent_color.copy()
@@ -795,34 +1716,64 @@ class DisplayMode(object):
                         hxhsl[i] += 0.3333333 + random.random() * 0.3333333
                         if hxhsl[i] > 1.0:
                             hxhsl[i] -= 1.0
+                    if hxhsl[2] < 0.25:
+                        hxhsl[2] += 0.5
+                    hxcolor = colorsys.hls_to_rgb(hxhsl[0],hxhsl[2],hxhsl[1])
                     break
                 else:
                     color_list.pop(0)
-                    hxhsl = color_list[0].copy()
-            if hxhsl[2] < 0.25:
-                hxhsl[2] += 0.5
-            hxcolor = colorsys.hls_to_rgb(hxhsl[0],hxhsl[2],hxhsl[1])
+                    hxhsl = self.palette_hsl[color_list[0]]
+                    hxcolor = self.palette_hex_rgb[color_list[0]]
             h.set_rgb(hxcolor)
             adjacent_color = h.get_hsl()
 
+    def compile_palette(self):
+        self.palette_hsl, self.palette_rgb, self.palette_packed, self.palette_hex_rgb = self.palettes[self.palette].make()
+
+        # the palette as a list of [h, s, l], for get_palette() and the colors ShootingStar picks
+        self.saved_palette = self.palette_hsl.tolist()
+        self.saved_palette_name = self.palette
+
+    def param(self, name, default):
+        """A parameter from the palette file, if it sets one; a list there means pick one."""
+        value = self.params.get(name, default)
+        if isinstance(value, list):
+            value = random.choice(value)
+        return value
+
+    def set_palettes(self, palettes, params=None):
+        """Swap in a new palette registry and parameters.  The palette changes right away;
+        other parameters are picked up when the mode next resets."""
+        self.params = params or {}
+        names = self.params.get("palettes")
+        if names:
+            palettes = dict((n, palettes[n]) for n in names if n in palettes) or palettes
+        self.palettes = palettes
+        if self.palette not in self.palettes:
+            self.palette = random.choice(list(self.palettes))
+        self.compile_palette()
+
     def reset(self):
         self.palette = random.choice(list(self.palettes))
-
-        self.saved_palette_name = ""
+        self.compile_palette()
 
 
 class Shimmer(DisplayMode):
-    def __init__(self, strip, hx, clear=True):
-        super(Shimmer, self).__init__(strip, hx, clear)
+    def __init__(self, strip, hx, clear=True, clock=None):
+        super(Shimmer, self).__init__(strip, hx, clear, clock)
         self.chance = 1.0
 
+        # seeded off numpy's global generator so seeding that still makes runs repeatable
+        self.rng = np.random.default_rng(np.random.randint(1 << 31))
+        self.draw = np.empty(self.length)
+
     def reset(self):
         super(Shimmer, self).reset()
-        self.chance = random.choice([0.1,0.5,0.75,1.0])
+        self.chance = self.param("chance", [0.1,0.5,0.75,1.0])
         if self.chance >= 0.75:
-            self.fps = 15
+            self.fps = self.param("fps", 15)
         else:
-            self.fps = 30
+            self.fps = self.param("fps", 30)
 
     def go(self, is_beat=False, volume=0.0):
 
@@ -831,15 +1782,21 @@ class Shimmer(DisplayMode):
         if do_beat:
             self.flip_hex_colors()
 
-        for i in range(self.length):
-            if random.random() < self.chance:
-                self.set_pixel_hsl(i, random.choice(self.get_palette()))
+        # a palette file can set chance to 0, and then nothing ever changes
+        if self.chance <= 0:
+            return
 
-        self.strip.show()
+        # one uniform draw per pixel does both jobs: under chance means the pixel changes,
+        # and where it fell under chance picks the color
+        self.rng.random(out=self.draw)
+        changed = self.draw < self.chance
+        idx = (self.draw[changed] * (len(self.palette_packed) / self.chance)).astype(np.intp)
+        np.minimum(idx, len(self.palette_packed) - 1, out=idx)
+        self.frame[changed] = self.palette_packed[idx]
 
 class Chase(DisplayMode):
-    def __init__(self, strip, hx, clear=True):
-        super(Chase, self).__init__(strip, hx, clear)
+    def __init__(self, strip, hx, clear=True, clock=None):
+        super(Chase, self).__init__(strip, hx, clear, clock)
         self.hxidx     = 0
         self.stripidx  = 0
         self.chase_dir = 1
@@ -847,16 +1804,13 @@ class Chase(DisplayMode):
     def reset(self):
         super(Chase, self).reset()
         self.chase_dir = random.choice([-1,1])
-        self.fps = 15
+        self.fps = self.param("fps", 15)
 
 
-    def chase_color(self,idx):
-        pl = len(self.get_palette())
-        while idx >= pl:
-            idx -= pl
-        while idx < 0:
-            idx += pl
-        return self.get_palette()[idx]
+    def compile_palette(self):
+        super(Chase, self).compile_palette()
+        # the palette repeated out past the end of the strip, so every step of the chase is one slice
+        self.ring = np.resize(self.palette_packed, self.length + len(self.palette_packed))
 
 
     def go(self, is_beat=False, volume=0.0):
@@ -865,8 +1819,8 @@ class Chase(DisplayMode):
         if do_beat:
             self.flip_hex_colors()
 
-        for i in range(self.length):
-            self.set_pixel_hsl(i, self.chase_color(self.stripidx + i))
+        offset = self.stripidx % len(self.palette_packed)
+        self.frame[:] = self.ring[offset:offset + self.length]
 
         self.stripidx += self.chase_dir
         if self.stripidx >= 65535:
@@ -874,11 +1828,9 @@ class Chase(DisplayMode):
         if self.stripidx < -65535:
             self.stripidx = 65535
 
-        self.strip.show()
-
 class Shift(DisplayMode):
-    def __init__(self, strip, hx, clear=True):
-        super(Shift, self).__init__(strip, hx, clear)
+    def __init__(self, strip, hx, clear=True, clock=None):
+        super(Shift, self).__init__(strip, hx, clear, clock)
         self.hxidx     = 0
         self.stripidx  = 0
         self.chase_dir = 1
@@ -888,56 +1840,63 @@ class Shift(DisplayMode):
 
     def reset(self):
         super(Shift, self).reset()
-        self.fps = random.randrange(10,30)
-
-        self.colormap1 = []
-        self.colormap2 = []
-
-        palette = self.get_palette()
-
-        blackcount = 0
-
-        while len(self.colormap1) < self.length:
-            for i in range(len(palette)):
-                color = palette[i]
-                halfway = len(self.colormap1) - self.length / 2
-                if halfway > 0:
-                    color[2] = max(color[2] * halfway / (self.length / 2.0), 0.0)
-                if color[2] == 0.0:
-                    blackcount += 1
-                else:
-                    blackcount = 0
-                if blackcount <= 3:
-                    for j in range(5):
-                        self.colormap1.append(color.copy())
-                        self.colormap2.append(color.copy())
-                    for j in range(10):
-                        self.colormap1.append(None)
-                        self.colormap2.append(None)
-
-        self.colormap2.reverse()
-
-        # fuzz the map a little
-        for j in range(10):
-            for i in range(len(self.colormap1)):
-                pickfrom = i + random.choice([2,1,1,-1,-1,-2])
-                if pickfrom < 0:
-                    pickfrom += len(self.colormap1)
-                if pickfrom >= len(self.colormap1):
-                    pickfrom -= len(self.colormap1)
-                holdcolor = self.colormap1[pickfrom]
-                self.colormap1[pickfrom] = self.colormap1[i]
-                self.colormap1[i] = holdcolor
-
-                # same for colormap2
-                pickfrom = i + random.choice([2,1,1,-1,-1,-2])
-                if pickfrom < 0:
-                    pickfrom += len(self.colormap2)
-                if pickfrom >= len(self.colormap2):
-                    pickfrom -= len(self.colormap2)
-                holdcolor = self.colormap2[pickfrom]
-                self.colormap2[pickfrom] = self.colormap2[i]
-                self.colormap2[i] = holdcolor
+        self.fps = self.param("fps", list(range(10,30)))
+
+    def compile_palette(self):
+        super(Shift, self).compile_palette()
+
+        # each block of the colormap is 5 pixels of one color, then 10 transparent ones
+        colors = pack_rgb(hsl_to_rgb_array(self.colormap_colors()))
+        packed = np.zeros((len(colors), 15), dtype=np.uint32)
+        packed[:, :5] = colors[:, None]
+        alpha = np.zeros(packed.shape, dtype=bool)
+        alpha[:, :5] = True
+        packed = packed.ravel()
+        alpha = alpha.ravel()
+
+        # the second map is the first one backwards, and both get fuzzed a little
+        perm = self.fuzz(len(packed))
+        self.ring1, self.alpha1 = self.colormap_ring(packed[perm], alpha[perm])
+        perm = self.fuzz(len(packed))
+        self.ring2, self.alpha2 = self.colormap_ring(packed[::-1][perm], alpha[::-1][perm])
+
+    def colormap_colors(self):
+        """HSL for each block of the colormap: the palette over and over until there's a
+        strip's worth, with no more than three blacks in a row, fading out toward the
+        middle of the strip and back in after it."""
+        palette = self.palette_hsl
+        black = palette[:,2] == 0.0
+
+        # the colors always make it in, so this many passes is always enough
+        passes = -(-self.length // (15 * max(len(palette) - black.sum(), 1))) + 1
+        order = np.tile(np.arange(len(palette)), passes)
+
+        # how far into a run of blacks each entry is (0 for colors)
+        i = np.arange(len(order))
+        run = i - np.maximum.accumulate(np.where(black[order], -1, i))
+        keep = run <= 3
+
+        # whole passes, until one starts with the strip already full
+        before = np.cumsum(keep) - keep # blocks ahead of each entry
+        full = np.flatnonzero(before[::len(palette)] * 15 >= self.length)
+        if len(full):
+            keep[full[0] * len(palette):] = False
+
+        hsl = palette[order[keep]] # a copy, so the cached palette stays as it is
+        halfway = before[keep] * 15 - self.length / 2.0
+        fade = halfway > 0
+        hsl[fade, 2] *= halfway[fade] / (self.length / 2.0)
+        return hsl
+
+    def fuzz(self, n):
+        """A random permutation that moves everything a few places either way, wrapping around."""
+        return np.argsort((np.arange(n) + np.random.uniform(-3.0, 3.0, n)) % n, kind="stable")
+
+    def colormap_ring(self, packed, alpha):
+        """A colormap's packed colors and mask (False where it's transparent), repeated
+        out to a strip's worth past the end so any rotation is one slice."""
+        n = max(len(packed), self.length) + self.length
+        return np.resize(packed, n), np.resize(alpha, n)
 
     def go(self, is_beat=False, volume=0.0):
 
@@ -945,24 +1904,11 @@ class Shift(DisplayMode):
         if do_beat:
             self.flip_hex_colors()
 
-        for i in range(self.length):
-            index = i + self.offset1
-            while index >= len(self.colormap1):
-                index -= len(self.colormap1)
-            while index < 0:
-                index += len(self.colormap1)
-
-            if self.colormap1[index] is not None:
-                self.set_pixel_hsl(i, self.colormap1[index])
-
-            index = i + self.offset2
-            while index >= len(self.colormap2):
-                index -= len(self.colormap2)
-            while index < 0:
-                index += len(self.colormap2)
-
-            if self.colormap2[index] is not None:
-                self.set_pixel_hsl(i, self.colormap2[index])
+        # two maps sliding past each other, the second drawn over the first; where both
+        # are transparent the pixel keeps whatever it had
+        n = self.length
+        np.copyto(self.frame, self.ring1[self.offset1:self.offset1 + n], where=self.alpha1[self.offset1:self.offset1 + n])
+        np.copyto(self.frame, self.ring2[self.offset2:self.offset2 + n], where=self.alpha2[self.offset2:self.offset2 + n])
 
         self.offset1 += 1
         if self.offset1 >= self.length:
@@ -972,35 +1918,29 @@ class Shift(DisplayMode):
         if self.offset2 < 0:
             self.offset2 += self.length
 
-        self.strip.show()
 
 
 
 class ShootingStar(DisplayMode):
-    def __init__(self, strip, hx, clear=True):
-        super(ShootingStar, self).__init__(strip, hx, clear)
-
-        self.hslfield = []
-        for i in range(0, strip.numPixels()):
-            self.hslfield.append([0,0,0])
-        self.hotSpots = [
-                {
-                    "x": 0.0,
-                    "hsl": self.get_nonblack_color(),
-                    "v": 1.0
-                },
-                {
-                    "x": self.length - 1,
-                    "hsl": self.get_nonblack_color(),
-                    "v": -1.0
-                }
-        ]
+    def __init__(self, strip, hx, clear=True, clock=None):
+        super(ShootingStar, self).__init__(strip, hx, clear, clock)
+
+        # the stars, as parallel arrays: position, velocity (pixels per frame) and color
+        self.star_x   = np.array([0.0, self.length - 1])
+        self.star_v   = np.array([1.0, -1.0])
+        self.star_hsl = np.array([self.get_nonblack_color(), self.get_nonblack_color()])
 
         self.color_index = 0
 
     def reset(self):
         super(ShootingStar, self).reset()
-        self.fps = 60
+        self.fps = self.param("fps", 60)
+        self.max_stars = self.param("max_stars", 256)
+
+    def add_star(self, x, v, hsl):
+        self.star_x   = np.append(self.star_x, x)
+        self.star_v   = np.append(self.star_v, v)
+        self.star_hsl = np.vstack((self.star_hsl, hsl))
 
     def next_star_color(self):
         if self.color_index >= len(self.get_palette()):
@@ -1018,107 +1958,388 @@ class ShootingStar(DisplayMode):
         if do_beat:
             self.flip_hex_colors()
 
-        if is_beat and len(self.hotSpots) < 16:
+        if is_beat and len(self.star_x) < self.max_stars:
             forward_color = self.next_star_color()
             if random.randrange(3) == 0:
-                self.hotSpots.append({
-                    "x": 0.0,
-                    "hsl": forward_color,
-                    "v": random.choice([1.0, 1.0, 1.0, 1.0, 1.0, 0.75, 0.5, 0.5, 0.25, 0.125])
-                })
+                self.add_star(0.0, random.choice([1.0, 1.0, 1.0, 1.0, 1.0, 0.75, 0.5, 0.5, 0.25, 0.125]), forward_color)
             if random.randrange(4) == 0:
                 reverse_color = self.next_star_color()
-                self.hotSpots.append({
-                    "x": self.length - 1,
-                    "hsl": reverse_color,
-                    "v": random.choice([-1.0, -1.0, -1.0, -0.5, -0.5, -0.25])
-                })
-
-        for h in self.hotSpots:
-            x = int(h["x"])
-            self.hslfield[x] = h["hsl"].copy()
-            self.hslfield[x][2] = 1.0
-            h["x"] += h["v"]
-            if h["x"] >= self.length or h["x"] < 0.0:
-                self.hotSpots.remove(h)
-
-        for i in range(self.length):
-            l = self.hslfield[i][2]
-            if l > 0.0:
-                l = l * 0.8
-                if l < 0.0001:
-                    l = 0.0
-                self.hslfield[i][2] = l
-                self.set_pixel_hsl(i,self.hslfield[i])
-
-        self.strip.show()
-
-
-
+                self.add_star(self.length - 1, random.choice([-1.0, -1.0, -1.0, -0.5, -0.5, -0.25]), reverse_color)
+
+        # every star lights its pixel at full brightness, then moves on
+        x = self.star_x.astype(np.intp)
+        self.hslbuf[x] = self.star_hsl
+        self.hslbuf[x,2] = 1.0
+        self.hsl_dirty = True
+
+        self.star_x += self.star_v
+        keep = (self.star_x >= 0.0) & (self.star_x < self.length)
+        if not keep.all():
+            self.star_x   = self.star_x[keep]
+            self.star_v   = self.star_v[keep]
+            self.star_hsl = self.star_hsl[keep]
+
+        # the frame buffer is the star field; fade the whole thing at once
+        l = self.hslbuf[:,2]
+        l *= 0.8
+        l[l < 0.0001] = 0.0
+
+
+
+
+class AnalysisRing(object):
+    """Audio analysis records in shared memory, one writer (the audio process) and one
+    reader (the main loop), no locks.
+
+    Every record carries its own sequence number, written last.  The reader only accepts a
+    record whose sequence number is the one it expects both before and after copying it,
+    so a record the writer is in the middle of replacing is counted as lost rather than
+    read torn.  As long as the reader keeps up to within `capacity` records, it sees every
+    record in order.
+
+    Band energies, if any, are the last n_bands columns of each record, from BANDS on.
+    """
+
+    SEQ    = 0
+    TIME   = 1 # time.monotonic() of the audio; for beats, of the beat itself
+    BEAT   = 2
+    VOLUME = 3
+    PEAK   = 4
+    BPM    = 5
+    ONSET  = 6
+    XRUNS  = 7 # running count of audio overruns, see HopRing
+    BANDS  = 8
+
+    def __init__(self, capacity=256, n_bands=0):
+        self.capacity = capacity
+        self.n_bands  = n_bands
+        self.width    = self.BANDS + n_bands
+        self.shared   = multiprocessing.RawArray('d', capacity * self.width)
+        self.head     = multiprocessing.RawValue('q', 0) # records ever written
+
+        self.read_count = 0
+        self.lost       = 0
+
+        self.attach()
+
+    def attach(self):
+        self.records = np.frombuffer(self.shared, dtype=np.float64).reshape(self.capacity, self.width)
+        self.records[:,self.SEQ] = -1.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["records"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.records = np.frombuffer(self.shared, dtype=np.float64).reshape(self.capacity, self.width)
+
+    def write(self, timestamp, beat, volume, peak, bpm, onset, xruns=0, bands=None):
+        n = self.head.value
+        rec = self.records[n % self.capacity]
+        rec[self.SEQ] = -1.0
+        rec[self.TIME:self.BANDS] = (timestamp, beat, volume, peak, bpm, onset, xruns)
+        if bands is not None:
+            rec[self.BANDS:] = bands
+        rec[self.SEQ] = n
+        self.head.value = n + 1
+
+    def read(self):
+        """Every record written since the last read, oldest first, as a (k, width) array."""
+        head = self.head.value
+        start = self.read_count
+        if head - start > self.capacity:
+            self.lost += head - start - self.capacity
+            start = head - self.capacity
+        self.read_count = head
+        if start == head:
+            return self.records[:0].copy()
+
+        expected = np.arange(start, head)
+        slots = expected % self.capacity
+        recs = self.records[slots]
+        good = (recs[:,self.SEQ] == expected) & (self.records[slots, self.SEQ] == expected)
+        self.lost += len(good) - np.count_nonzero(good)
+        return recs[good]
+
+class HopRing(object):
+    """Captured audio hops, passed from PyAudio's callback thread to the analysis loop.
+
+    The callback only copies the hop into a preallocated slot and never blocks.  If the
+    analysis falls more than max_backlog hops behind, the oldest ones are skipped so audio
+    latency stays bounded; those, plus any input overflows PortAudio reports, are counted
+    in overruns instead of being raised.
+    """
+
+    def __init__(self, hop_s, capacity=32, max_backlog=8, dtype=np.float32):
+        self.hops        = np.zeros((capacity, hop_s), dtype=dtype)
+        self.times       = np.zeros(capacity)
+        self.dtype       = dtype
+        self.capacity    = capacity
+        self.max_backlog = max_backlog
+
+        self.head = 0 # hops captured; only the callback changes this
+        self.tail = 0 # hops consumed; only the analysis loop changes this
+        self.ready = threading.Event()
+
+        self.input_overflows = 0
+        self.skipped = 0
+
+    @property
+    def overruns(self):
+        return self.input_overflows + self.skipped
+
+    def callback(self, in_data, frame_count, time_info, status):
+        if status & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        np.copyto(self.hops[self.head % self.capacity], np.frombuffer(in_data, dtype=self.dtype))
+        self.times[self.head % self.capacity] = time.monotonic()
+        self.head += 1
+        self.ready.set()
+        return (None, pyaudio.paContinue)
+
+    def get(self, out, timeout=0.1):
+        """Copy the next hop into out and return when the callback got it, or None if
+        nothing arrived within timeout."""
+        self.ready.clear()
+        if self.head == self.tail:
+            self.ready.wait(timeout)
+            if self.head == self.tail:
+                return None
+
+        backlog = self.head - self.tail
+        if backlog > self.max_backlog:
+            self.skipped += backlog - self.max_backlog
+            self.tail = self.head - self.max_backlog
+
+        np.copyto(out, self.hops[self.tail % self.capacity])
+        captured = self.times[self.tail % self.capacity]
+        self.tail += 1
+        # the callback may have lapped us while we were copying
+        if self.head - self.tail >= self.capacity:
+            self.skipped += 1
+            return None
+        return captured
+
+def band_count(bands):
+    return bands if isinstance(bands, int) else len(bands) - 2
+
+def parse_bands(spec, samplerate=AUDIO_SAMPLERATE):
+    """Bands (see AUDIO_BANDS) from "f1,f2,f3,..." or "mel:N"; ValueError if they won't
+    make a filterbank."""
+    if spec.startswith("mel:"):
+        bands = int(spec[4:])
+        if bands < 1:
+            raise ValueError("mel:N needs at least one band")
+        return bands
+
+    bands = [float(f) for f in spec.split(",")]
+    if band_count(bands) < 1:
+        raise ValueError("one band takes three frequencies, and each one more after that")
+    if bands[0] <= 0 or any(b <= a for a, b in zip(bands, bands[1:])):
+        raise ValueError("frequencies have to be positive and go up")
+    if bands[-1] >= samplerate / 2.0:
+        raise ValueError("frequencies have to be below %g Hz" % (samplerate / 2.0))
+    return bands
+
+def make_filterbank(bands, win_s, samplerate):
+    fb = aubio.filterbank(band_count(bands), win_s)
+    if isinstance(bands, int):
+        fb.set_mel_coeffs(samplerate, 40.0, 16000.0)
+    else:
+        fb.set_triangle_bands(aubio.fvec(bands), samplerate)
+    return fb
+
+# Session files: a header, then one fixed-size record per hop with the analysis and the
+# hop's audio as 16-bit samples, so a whole session can be memory-mapped as one array.
+SESSION_MAGIC   = b"DNYS"
+SESSION_VERSION = 1
+SESSION_HEADER  = struct.Struct("<4sHIIH") # magic, version, samplerate, hop size, bands
+
+def session_dtype(hop_s, n_bands):
+    return np.dtype([
+        ("time",   "<f8"),
+        ("beat",   "u1"),
+        ("volume", "<f4"),
+        ("peak",   "<f4"),
+        ("bpm",    "<f4"),
+        ("onset",  "<f4"),
+        ("xruns",  "<u4"),
+        ("bands",  "<f4", (n_bands,)),
+        ("audio",  "<i2", (hop_s,)),
+    ])
+
+class SessionRecorder(object):
+    """Appends every hop the audio process analyses, audio included, to a session file."""
+
+    def __init__(self, path, samplerate, hop_s, n_bands):
+        self.f = open(path, "wb")
+        self.f.write(SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, samplerate, hop_s, n_bands))
+        self.rec = np.zeros(1, dtype=session_dtype(hop_s, n_bands))
+        self.scratch = np.zeros(hop_s, dtype=np.float32)
+
+    def write(self, hop_time, beat, volume, peak, bpm, onset, xruns, bands, samples):
+        rec = self.rec
+        rec["time"]   = hop_time
+        rec["beat"]   = beat
+        rec["volume"] = volume
+        rec["peak"]   = peak
+        rec["bpm"]    = bpm
+        rec["onset"]  = onset
+        rec["xruns"]  = xruns
+        rec["bands"]  = bands
+        np.clip(samples, -1.0, 1.0, out=self.scratch)
+        self.scratch *= 32767.0
+        rec["audio"] = self.scratch
+        rec.tofile(self.f)
+
+    def close(self):
+        self.f.close()
+
+def load_session(path):
+    """Returns (samplerate, hop size, band count, records) with records memory-mapped."""
+    with open(path, "rb") as f:
+        magic, version, samplerate, hop_s, n_bands = SESSION_HEADER.unpack(f.read(SESSION_HEADER.size))
+    if magic != SESSION_MAGIC or version != SESSION_VERSION:
+        raise ValueError("%s is not a version %s session file" % (path, SESSION_VERSION))
+    records = np.memmap(path, dtype=session_dtype(hop_s, n_bands), mode="r", offset=SESSION_HEADER.size)
+    return samplerate, hop_s, n_bands, records
+
+class HopAnalyzer(object):
+    """The per-hop analysis: aubio beat tracking, frame energy, onset strength and band
+    energies.  Shared by the live audio process and offline WAV analysis so both see
+    exactly the same thing.
+
+    After each call, volume is the energy at the latest beat and peak_volume carries the
+    previous one, which is what the mode logic in main() compares against.
+
+    Each hop comes with the time its last sample was played.  aubio says where a beat
+    was by its position in the samples it's been fed, so the beat time is worked out
+    from the time of the hop that position falls in.  Hops dropped on overrun never
+    reach aubio, and this way they can't shift beat times.
+    """
+
+    HOP_HISTORY = 32 # hops back a beat can be placed; aubio reports them well within this
+
+    def __init__(self, samplerate=AUDIO_SAMPLERATE, win_s=AUDIO_WIN_S, bands=AUDIO_BANDS):
+        self.samplerate = samplerate
+        self.win_s = win_s                  # fft size
+        self.hop_s = win_s // 2             # hop size
+
+        if aubio is None:
+            raise RuntimeError("beat detection needs aubio (pip install aubio)")
+        self.tempo = aubio.tempo("default", self.win_s, self.hop_s, samplerate)
+
+        # onset strength and band energies, both from one phase vocoder pass per hop
+        self.pvoc = aubio.pvoc(self.win_s, self.hop_s)
+        self.flux = aubio.specdesc("specflux", self.win_s)
+        self.filterbank = make_filterbank(bands, self.win_s, samplerate)
+        self.band_energy = np.zeros(band_count(bands))
+
+        self.processed = 0 # samples fed to aubio so far
+        self.running_peak_volume = 0.0 # we're using this so that the peaks carry between beats, inclusive
+
+        self.energy      = 0.0
+        self.onset       = 0.0
+        self.volume      = 0.0
+        self.peak_volume = 0.0
+        self.tempo_bpm   = 0.0
+        self.beat_time   = 0.0
+
+        self.hop_end_times = np.zeros(self.HOP_HISTORY)
+
+    def __call__(self, samples, end_time=0.0):
+        """Analyse one hop whose last sample was played at end_time; returns True if it has
+        a beat in it, and then beat_time says when."""
+        hop = self.processed // self.hop_s
+        self.hop_end_times[hop % self.HOP_HISTORY] = end_time
+        is_beat = bool(self.tempo(samples))
+        self.processed += self.hop_s
+        # Compute the energy (volume) of the
+        # current frame, without squaring into a temporary.
+        self.energy = float(np.dot(samples, samples)) / self.hop_s
+        spectrum = self.pvoc(samples)
+        self.onset = float(self.flux(spectrum)[0])
+        self.band_energy[:] = self.filterbank(spectrum)
+
+        self.peak_volume = max(self.running_peak_volume, self.volume)
+        if is_beat:
+            self.tempo_bpm = self.tempo.get_bpm()
+            # aubio knows where in what it was fed the beat was; find the hop that's in
+            last = min(int(self.tempo.get_last()), self.processed - 1)
+            beat_hop = max(last // self.hop_s, hop - self.HOP_HISTORY + 1)
+            after = (beat_hop + 1) * self.hop_s - max(last, beat_hop * self.hop_s)
+            self.beat_time = self.hop_end_times[beat_hop % self.HOP_HISTORY] - after / float(self.samplerate)
+            self.volume = self.energy
+            self.running_peak_volume = self.volume
+        return is_beat
 
 def beat_detect_proc(
     shared_exiting,
-    shared_is_beat,
-    shared_volume,
-    shared_peak_volume,
-    shared_tempo_bpm
+    ring,
+    bands=AUDIO_BANDS,
+    record_path=None
         ):
 
     ### set up all the bpm detection stuff
 
-    win_s = 2048                # fft size
-    hop_s = win_s // 2          # hop size
+    analyzer = HopAnalyzer(bands=bands)
+    hop_s = analyzer.hop_s
+    samplerate = analyzer.samplerate
 
     p = pyaudio.PyAudio()
 
-    samplerate=44100
-    a_tempo = aubio.tempo("default", win_s, hop_s, samplerate)
+    # the hop we hand to aubio lives here for the life of the process
+    samples = np.zeros(hop_s, dtype=aubio.float_type)
+    hops = HopRing(hop_s, dtype=aubio.float_type)
 
     stream = None
     try:
         stream = None
-        # Open stream.
+        # Open stream.  Capture runs in PortAudio's thread, so being descheduled here
+        # costs us hops (counted) instead of an overflow exception.
         stream = p.open(
                 format=pyaudio.paFloat32,
                 channels=1,
                 rate=samplerate,
                 input=True,
-                frames_per_buffer=1024,
+                frames_per_buffer=hop_s,
+                stream_callback=hops.callback,
                 )
 
         stream.start_stream()
     except OSError:
         pass
 
-    fake_beat_start = time.time()
-    running_peak_volume = 0.0 # we're using this so that the peaks carry between beats, inclusive
+    # the last sample of a hop reached the callback this long after it was played
+    input_latency = stream.get_input_latency() if stream else 0.0
+
+    recorder = None
+    if record_path:
+        recorder = SessionRecorder(record_path, samplerate, hop_s, band_count(bands))
 
+    fake_beat_start = time.time()
     is_beat = False
-    volume = 0.0
-    peak_volume = 0.0
-    tempo_bpm = 0.0
 
     try:
 
         while bool(shared_exiting.value) is False:
             is_beat = False
             if stream:
-                data = stream.read(1024)
-                samples = np.fromstring(data,
-                    dtype=aubio.float_type)
-                tempo = a_tempo(samples)
-                # Compute the energy (volume) of the
-                # current frame.
-                current_volume = np.sum(samples**2)/len(samples)
-
-                peak_volume = max(running_peak_volume, volume)
-                if tempo:
-                    tempo_bpm = a_tempo.get_bpm()
-                    is_beat = True
-                    volume = current_volume
-                    running_peak_volume = volume
+                captured = hops.get(samples)
+                if captured is None:
+                    if not stream.is_active():
+                        raise OSError("audio stream stopped")
+                    continue
+                hop_time = captured - input_latency
+                is_beat = analyzer(samples, hop_time)
+                if is_beat:
+                    # stamp the record with when the beat was, not when we noticed it
+                    hop_time = analyzer.beat_time
 
             else:
+                hop_time = time.monotonic()
                 fake_beat_elapsed = time.time() - fake_beat_start
                 if fake_beat_elapsed > 0.25:
                     is_beat = True
@@ -1127,41 +2348,339 @@ def beat_detect_proc(
             if not stream:
                 time.sleep(0.001)
 
-            shared_is_beat.value     = bool(shared_is_beat.value) or is_beat
-            shared_volume.value      = volume
-            shared_peak_volume.value = peak_volume
-            shared_tempo_bpm.value   = tempo_bpm
+            # one record per hop; without audio there's nothing to say between fake beats
+            if stream or is_beat:
+                a = analyzer
+                ring.write(hop_time, is_beat, a.volume, a.peak_volume, a.tempo_bpm, a.onset, hops.overruns, a.band_energy)
+                if recorder:
+                    recorder.write(hop_time, is_beat, a.volume, a.peak_volume, a.tempo_bpm, a.onset, hops.overruns, a.band_energy, samples)
 
         if stream:
             stream.stop_stream()
             stream.close()
+        if recorder:
+            recorder.close()
 
     except:
 
         print("Error in audio proc: %s" % sys.exc_info()[0])
         shared_exiting.value = True
+        if recorder:
+            recorder.close()
         raise
 
+def beat_replay_proc(
+    shared_exiting,
+    ring,
+    path,
+    speed=1.0
+        ):
+    """Stands in for beat_detect_proc, feeding a recorded session into the ring at `speed`
+    times real time.  Timestamps are moved to now and squeezed by the same factor."""
 
+    try:
+        samplerate, hop_s, n_bands, records = load_session(path)
+        if len(records) == 0:
+            return
+
+        t0 = float(records["time"][0])
+        start = time.monotonic()
+
+        for n in range(len(records)):
+            if bool(shared_exiting.value):
+                break
+            rec = records[n]
+            t = start + (float(rec["time"]) - t0) / speed
+            delay = t - time.monotonic()
+            if delay > 0.001:
+                time.sleep(delay)
+            ring.write(t, rec["beat"], rec["volume"], rec["peak"], rec["bpm"], rec["onset"], rec["xruns"], rec["bands"])
 
+    except:
 
-if __name__ == '__main__':
+        print("Error in replay proc: %s" % sys.exc_info()[0])
+        shared_exiting.value = True
+        raise
+
+class SessionFeeder(object):
+    """Replays a recorded session into the ring from the main loop, on the frame clock,
+    instead of from a process sleeping on wall time.  On a VirtualClock that makes a
+    replay run as fast as the modes can render it and come out the same every time.
 
-    # globals that I'm being an asshole and not locking properly
-    shared_exiting     = multiprocessing.Value('b', False, lock=False)
-    shared_is_beat     = multiprocessing.Value('b', False, lock=False)
-    shared_volume      = multiprocessing.Value('f', 0.0, lock=False)
-    shared_peak_volume = multiprocessing.Value('f', 0.0, lock=False)
-    shared_tempo_bpm   = multiprocessing.Value('f', 0.0, lock=False)
+    feed() goes once per frame and hands over every record the clock has passed, in
+    recorded order, with timestamps moved to start from `start`.
+    """
 
-    # Create NeoPixel object with appropriate configuration.
-    strip = Adafruit_NeoPixel(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL, LED_STRIP)
-    # Intialize the library (must be called once before other functions).
-    strip.begin()
+    def __init__(self, path, ring, start=0.0):
+        self.records = load_session(path)[3]
+        self.ring = ring
 
+        times = np.asarray(self.records["time"], dtype=float)
+        self.times = times - (times[0] if len(times) else 0.0) + start
+        # beats are stamped back to when they happened; they still can't arrive before the hop ahead of them
+        self.due = np.maximum.accumulate(self.times) if len(times) else self.times
+        self.next = 0
 
-    pwm = Adafruit_PCA9685.PCA9685()
-    pwm.set_pwm_freq(120)
+    def done(self):
+        return self.next >= len(self.records)
+
+    def feed(self, now):
+        while self.next < len(self.records) and self.due[self.next] <= now:
+            rec = self.records[self.next]
+            self.ring.write(self.times[self.next], rec["beat"], rec["volume"], rec["peak"], rec["bpm"], rec["onset"], rec["xruns"], rec["bands"])
+            self.next += 1
+
+### offline analysis of WAV files, cached as beat grids
+
+WAV_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+def read_wav(path):
+    """Samples of a PCM WAV file as mono float32 in -1..1, and its sample rate."""
+    w = wave.open(path, "rb")
+    try:
+        channels = w.getnchannels()
+        width = w.getsampwidth()
+        samplerate = w.getframerate()
+        data = w.readframes(w.getnframes())
+    finally:
+        w.close()
+    if width not in WAV_DTYPES:
+        raise ValueError("%s: %d-bit samples aren't supported" % (path, width * 8))
+
+    samples = np.frombuffer(data, dtype=WAV_DTYPES[width]).astype(np.float32)
+    if width == 1:
+        samples -= 128.0 # 8-bit WAV is unsigned
+    samples /= float(1 << (width * 8 - 1))
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples, samplerate
+
+def analyze_wav(path, bands=AUDIO_BANDS):
+    """Run a WAV file through the same HopAnalyzer the live audio goes through.
+
+    Returns the beat grid, one row per beat of (time, bpm, volume, peak) with times in
+    seconds from the start of the track, and the per-hop volume envelope.
+    """
+    samples, samplerate = read_wav(path)
+    analyzer = HopAnalyzer(samplerate=samplerate, bands=bands)
+    hop_s = analyzer.hop_s
+
+    n_hops = len(samples) // hop_s
+    hop = np.zeros(hop_s, dtype=aubio.float_type)
+    envelope = np.zeros(n_hops, dtype=np.float32)
+    beats = []
+    for n in range(n_hops):
+        hop[:] = samples[n * hop_s:(n + 1) * hop_s]
+        if analyzer(hop, (n + 1) * hop_s / float(samplerate)):
+            beats.append((analyzer.beat_time, analyzer.tempo_bpm, analyzer.volume, analyzer.peak_volume))
+        envelope[n] = analyzer.energy
+
+    return np.array(beats, dtype=np.float64).reshape(-1, 4), envelope, hop_s / float(samplerate)
+
+def _analyze_track(job):
+    path, bands = job
+    try:
+        return (path,) + analyze_wav(path, bands)
+    except (EOFError, ValueError, wave.Error) as e:
+        print("Skipping %s: %s" % (path, e))
+        return None
+
+def analyze_dir(directory, cache_path, bands=AUDIO_BANDS, processes=None):
+    """Analyse every WAV file under `directory`, one track per core, and save the beat
+    grids and volume envelopes to `cache_path` (an .npz).  Tracks are keyed by file
+    name without the extension."""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(".wav"))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = [r for r in pool.imap_unordered(_analyze_track, [(p, bands) for p in paths]) if r]
+    finally:
+        pool.close()
+        pool.join()
+
+    names = []
+    arrays = {}
+    for path, beats, envelope, hop_time in sorted(results):
+        n = len(names)
+        names.append(os.path.splitext(os.path.basename(path))[0])
+        arrays["beats_%d" % n]    = beats
+        arrays["envelope_%d" % n] = envelope
+        arrays["hop_time_%d" % n] = hop_time
+    np.savez_compressed(cache_path, names=np.array(names, dtype=str), **arrays)
+    return names
+
+def load_beat_grids(cache_path):
+    """The cache written by analyze_dir, as {name: (beats, envelope, hop_time)}."""
+    cache = np.load(cache_path)
+    grids = {}
+    for n, name in enumerate(cache["names"]):
+        grids[str(name)] = (cache["beats_%d" % n], cache["envelope_%d" % n], float(cache["hop_time_%d" % n]))
+    return grids
+
+def count_mode_changes(grids, **thresholds):
+    """How many times ModeSwitcher with these thresholds would change mode in each track."""
+    changes = {}
+    for name, (beats, envelope, hop_time) in grids.items():
+        switcher = ModeSwitcher(verbose=False, **thresholds)
+        changes[name] = sum(switcher.beat(bpm, peak, volume) for t, bpm, volume, peak in beats)
+    return changes
+
+def beat_grid_proc(
+    shared_exiting,
+    ring,
+    beats,
+    speed=1.0
+        ):
+    """Stands in for beat_detect_proc, playing a cached beat grid into the ring from the
+    moment it starts.  Start it with the track."""
+
+    try:
+        start = time.monotonic()
+        for beat_time, bpm, volume, peak in beats:
+            if bool(shared_exiting.value):
+                break
+            t = start + beat_time / speed
+            delay = t - time.monotonic()
+            if delay > 0.001:
+                time.sleep(delay)
+            ring.write(t, True, volume, peak, bpm, 0.0)
+
+    except:
+
+        print("Error in beat grid proc: %s" % sys.exc_info()[0])
+        shared_exiting.value = True
+        raise
+
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Lighting controller for Dionysus")
+    parser.add_argument("--frame-policy", choices=["drop", "catchup"], default="drop",
+            help="what to do when a frame misses its deadline (default: drop)")
+    parser.add_argument("--profile", action="store_true",
+            help="time the render and output paths; dump with SIGUSR1")
+    parser.add_argument("--profile-interval", type=float, default=0.0, metavar="SECONDS",
+            help="also dump the profile every SECONDS (implies --profile)")
+    parser.add_argument("--bands", default=None, metavar="FREQS|mel:N",
+            help="audio bands to analyse: comma-separated triangle filter corner frequencies, "
+                 "or mel:N for N mel bands (default: bass, mid, treble)")
+    parser.add_argument("--latency", type=float, default=0.0, metavar="SECONDS",
+            help="extra delay from frame to visible light to compensate for, on top of the "
+                 "measured output latency (default: 0)")
+    parser.add_argument("--no-predict", action="store_true",
+            help="show beats when they're detected instead of predicting them")
+    parser.add_argument("--record", metavar="FILE",
+            help="save the audio and its analysis to a session file as we go")
+    parser.add_argument("--replay", metavar="FILE",
+            help="run from a recorded session file instead of live audio")
+    parser.add_argument("--replay-speed", type=float, default=None, metavar="X",
+            help="replay in real time, sped up X times (default: replay sessions on a virtual "
+                 "clock as fast as possible, and play beat grids in real time)")
+    parser.add_argument("--seed", type=int, default=None,
+            help="seed the random number generators, for repeatable runs")
+    parser.add_argument("--analyze", metavar="DIR",
+            help="analyse the WAV files in DIR into the beat grid cache, print how often "
+                 "each would change modes, and exit")
+    parser.add_argument("--beat-grids", default="beatgrids.npz", metavar="FILE",
+            help="beat grid cache for --analyze and --track (default: beatgrids.npz)")
+    parser.add_argument("--palettes", metavar="FILE",
+            help="load palettes and mode parameters from a JSON file, and reload it when it changes")
+    parser.add_argument("--track", metavar="NAME",
+            help="play the cached beat grid for NAME, starting now, instead of listening")
+    parser.add_argument("--null-output", action="store_true",
+            help="render without touching the strip or the PCA9685 (for replays off the vehicle)")
+    parser.add_argument("--layout", metavar="FILE",
+            help="physical strip layout, a JSON list of [channel, offset, count, reversed] "
+                 "segments (default: LED_LAYOUT)")
+    parser.add_argument("--sync-output", action="store_true",
+            help="write to the strip and PWM from the render loop instead of an output thread")
+    args = parser.parse_args()
+
+    if args.profile or args.profile_interval > 0.0:
+        profiler = Profiler(interval=args.profile_interval)
+        profiler.install_signal()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
+    # a replay with no speed given runs everything on a virtual clock: as fast as the
+    # frames can be rendered, and the same every time for the same seed
+    virtual = args.replay is not None and args.replay_speed is None
+    if virtual:
+        frame_clock = VirtualClock()
+
+    bands = AUDIO_BANDS
+    if args.bands is not None:
+        try:
+            bands = parse_bands(args.bands)
+        except ValueError as e:
+            parser.error("bad --bands %s: %s" % (args.bands, e))
+
+    if args.analyze and aubio is None:
+        parser.error("--analyze needs aubio (pip install aubio)")
+    if not (args.analyze or args.replay or args.track) and (aubio is None or pyaudio is None):
+        parser.error("listening to live audio needs aubio and PyAudio; --replay and --track work without them")
+
+    if args.analyze:
+        names = analyze_dir(args.analyze, args.beat_grids, bands)
+        grids = load_beat_grids(args.beat_grids)
+        changes = count_mode_changes(grids)
+        for name in names:
+            beats, envelope, hop_time = grids[name]
+            bpm = beats[-1, 1] if len(beats) else 0.0
+            print("%-40s %6.1f s %5d beats %6.1f bpm %4d mode changes" % (
+                name, len(envelope) * hop_time, len(beats), bpm, changes[name]))
+        sys.exit(0)
+
+    grid = None
+    if args.track:
+        grid = load_beat_grids(args.beat_grids)[args.track][0]
+
+    shared_exiting = multiprocessing.Value('b', False, lock=False)
+    if args.replay:
+        # sped-up replays hand over a lot more records per frame
+        n_bands = load_session(args.replay)[2]
+        ring = AnalysisRing(capacity=max(256, int(256 * (args.replay_speed or 1.0))), n_bands=n_bands)
+    else:
+        ring = AnalysisRing(n_bands=band_count(bands))
+
+    layout = StripLayout(load_layout(args.layout) if args.layout else LED_LAYOUT)
+
+    neopixel = None
+    multistrip = None
+    if args.null_output:
+        strip = NullPixelDriver(layout.length)
+        pwm = NullPWMDriver()
+    else:
+        if layout.is_plain():
+            channel, offset, count, rev = layout.segments[0]
+            # Create NeoPixel object with appropriate configuration.
+            neopixel = Adafruit_NeoPixel(count, LED_CHANNEL_PINS[channel], LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, channel, LED_STRIP)
+            # Intialize the library (must be called once before other functions).
+            neopixel.begin()
+            strip = WS281xDriver(neopixel)
+        else:
+            # the modes draw the logical strip; this scatters it over both channels
+            multistrip = WS281xMultiDriver(layout)
+            strip = multistrip
+
+
+        pca9685 = Adafruit_PCA9685.PCA9685()
+        pca9685.set_pwm_freq(120)
+        pwm = PCA9685Driver(pca9685)
+
+    output = None
+    # the output thread runs on real time, so it has no place in a virtual one
+    if not args.sync_output and not virtual:
+        output = OutputThread(strip, pwm)
+        output.start()
+        strip = output.pixel_output
+        pwm   = output.pwm_output
     hx = [
         LED(pwm,  0,  1,  2),
         LED(pwm,  3,  4,  5),
@@ -1173,9 +2692,7 @@ if __name__ == '__main__':
         h.set_rgb([0, 0, 0])
 
     thruster = Thruster(pwm, 15)
-
-    elapsed = 0.0
-    last_time = time.time()
+    pwm.show()
 
     display_modes = {
         "Shooting Star": ShootingStar(strip, hx),
@@ -1184,134 +2701,150 @@ if __name__ == '__main__':
         "Shift": Shift(strip, hx),
     }
     current_mode = "Shift"
-    beat_count = 0
-
-    audio_process = multiprocessing.Process(target=beat_detect_proc, args=(
-        shared_exiting,
-        shared_is_beat,
-        shared_volume,
-        shared_peak_volume,
-        shared_tempo_bpm
-        ))
-    audio_process.start()
-
-    running_beat_volume = []
-
-    avg_beat_volume = 0.0
-    max_beat_volume = 0.0
-    min_beat_volume = 0.0
-    is_quiet = False
-    prev_peak_volume = 0.0
-    prev_tempo_bpm = 0.0
-
-    last_beat      = time.time()
+
+    watcher = None
+    if args.palettes:
+        watcher = PaletteWatcher(args.palettes, list(display_modes.values()))
+        watcher.poll(frame_clock.now)
+
+    scheduler = FrameScheduler(policy=args.frame_policy)
+    predictor = BeatPredictor(latency=args.latency)
+
+    audio_process = None
+    feeder = None
+    if virtual:
+        feeder = SessionFeeder(args.replay, ring, frame_clock.now)
+    elif args.replay:
+        audio_process = multiprocessing.Process(target=beat_replay_proc, args=(
+            shared_exiting,
+            ring,
+            args.replay,
+            args.replay_speed
+            ))
+    elif grid is not None:
+        audio_process = multiprocessing.Process(target=beat_grid_proc, args=(
+            shared_exiting,
+            ring,
+            grid,
+            args.replay_speed or 1.0
+            ))
+    else:
+        audio_process = multiprocessing.Process(target=beat_detect_proc, args=(
+            shared_exiting,
+            ring,
+            bands,
+            args.record
+            ))
+    if audio_process:
+        audio_process.start()
+
+    switcher = ModeSwitcher()
+
+    last_beat      = frame_clock.now
     half_beat_done = True
 
+    volume      = 0.0
+    peak_volume = 0.0
+    tempo_bpm   = 0.0
+    bands       = np.zeros(ring.n_bands)
+
     try:
 
         exiting = bool(shared_exiting)
 
-        while exiting is False and audio_process.is_alive():
-            exiting     = bool(shared_exiting.value)
-            is_beat     = bool(shared_is_beat.value)
-            volume      = float(shared_volume.value)
-            peak_volume = float(shared_peak_volume.value)
-            tempo_bpm   = float(shared_tempo_bpm.value)
+        while exiting is False and (not feeder.done() if feeder else audio_process.is_alive()):
+            slack = scheduler.wait(display_modes[current_mode].fps)
+            now = frame_clock.tick() # the time for everything in this frame
+            if profiler:
+                profiler.record("slack", slack)
+                profiler.tick()
+
+            exiting = bool(shared_exiting.value)
+            if feeder:
+                feeder.feed(now)
+            records = ring.read()
+            if len(records):
+                volume      = float(records[-1, AnalysisRing.VOLUME])
+                peak_volume = float(records[-1, AnalysisRing.PEAK])
+                tempo_bpm   = float(records[-1, AnalysisRing.BPM])
+                bands       = records[-1, AnalysisRing.BANDS:]
+            beats = records[records[:, AnalysisRing.BEAT] > 0.0]
 
-            last_time = time.time()
             bpm_time = 60.0 / max(tempo_bpm, 60.0)
 
             half_beat_active = False
             if tempo_bpm < 70 and tempo_bpm > 50.0:
                 half_beat_active = True
 
-            if not is_beat:
-                if half_beat_active and half_beat_done is False and last_beat + bpm_time / 2.0 <= time.time():
-                    last_half_beat = time.time()
-                    display_modes[current_mode].go_wrap(True, volume)
-                    half_beat_done = True
-                else:
-                    display_modes[current_mode].go_wrap(False, volume)
-
-            else:
-
-                last_beat = time.time()
-                half_beat_done = False
-                changing = False
-                tempo_diff    = (max(tempo_bpm,prev_tempo_bpm) + 0.0001) / (min(tempo_bpm, prev_tempo_bpm) + 0.0001)
-                max_peak_diff = (peak_volume + 0.0001)                   / (max_beat_volume + 0.0001)
-                min_peak_diff = (min_beat_volume + 0.0001)               / (peak_volume + 0.0001)
-
-                print(" ** beat %s @%s - td %s, maxpd %s, minpd %s" % (
-                    beat_count,
-                    "{:.6f}".format(tempo_bpm),
-                    "{:.6f}".format(tempo_diff),
-                    "{:.6f}".format(max_peak_diff),
-                    "{:.6f}".format(min_peak_diff),
-                    ))
+            # every beat since the last frame counts toward the mode logic, in order
+            for beat in beats:
+                volume      = float(beat[AnalysisRing.VOLUME])
+                peak_volume = float(beat[AnalysisRing.PEAK])
+                tempo_bpm   = float(beat[AnalysisRing.BPM])
 
-                thruster.blink()
-
-                if beat_count >= 2 and tempo_diff > 1.01:
-                    print("%s: t %s != %s (%s)" % (beat_count, "{:.2f}".format(tempo_bpm), "{:.2f}".format(prev_tempo_bpm), "{:.2f}".format(tempo_diff)))
-                    changing = True
-                elif beat_count >= 2 and max_peak_diff > 2.0:
-                    print("%s: %s > %s (%s)" % (beat_count, "{:.6f}".format(peak_volume), "{:.6f}".format(max_beat_volume), "{:.2f}".format(max_peak_diff)))
-                    changing = True
-                    is_quiet = False
-                elif beat_count >= 4 and min_peak_diff > 5.0:
-                    print("%s: %s < %s (%s)" % (beat_count, "{:.6f}".format(peak_volume), "{:.6f}".format(min_beat_volume), "{:.2f}".format(min_peak_diff)))
-                    is_quiet = True
-                    changing = True
-                elif volume < 0.00001 and beat_count == 32:
-                    print("32 beats")
-                    changing = True
-                elif beat_count == 128:
-                    print("128 beats")
-                    changing = True
-                if changing:
-
-                    beat_count = 0
+                if switcher.beat(tempo_bpm, peak_volume, volume):
                     current_mode = random.choice(list(display_modes))
                     display_modes[current_mode].reset()
                     print("Mode: %s; palette: %s" % (current_mode, display_modes[current_mode].palette))
+                    print("Frames: %s late, %s dropped" % (scheduler.late_frames, scheduler.dropped_frames))
+                    if output:
+                        print("Output: %s pixel and %s PWM frames superseded before they were sent" % (
+                            output.dropped["pixels"], output.dropped["pwm"]))
+                    err, abs_err = predictor.error()
+                    print("Beat prediction: %.1f ms mean error, %.1f ms mean absolute" % (err * 1000.0, abs_err * 1000.0))
+                    if ring.lost or beat[AnalysisRing.XRUNS]:
+                        print("Audio: %d overruns, %s analysis records lost" % (beat[AnalysisRing.XRUNS], ring.lost))
+
+                predictor.observe(float(beat[AnalysisRing.TIME]), tempo_bpm)
+
+            ## handle the display stuff
+
+            # show beats where the predicted grid says they are, once it has locked on
+            predictor.latency = args.latency + (output.latency if output else 0.0)
+            if args.no_predict or not predictor.confident(now):
+                visual_beat = len(beats) > 0
+                if visual_beat:
+                    predictor.last_fired = now # so it doesn't fire this beat again once it locks on
+            else:
+                visual_beat = predictor.due(now)
 
-
-                running_beat_volume.append(peak_volume)
-                if len(running_beat_volume) > 4:
-                    del running_beat_volume[0]
-
-                max_beat_volume = max(running_beat_volume)
-                min_beat_volume = min(running_beat_volume)
-
-                prev_peak_volume = peak_volume
-                prev_tempo_bpm = tempo_bpm
-
-                ## handle the display stuff
-
-                display_modes[current_mode].go_wrap(True, volume)
-                beat_count += 1
-                is_beat = False
-
-                shared_is_beat.value = is_beat
+            if visual_beat:
+                last_beat = now
+                half_beat_done = False
+                thruster.blink()
+                display_modes[current_mode].go_wrap(True, volume, bands)
+            elif half_beat_active and half_beat_done is False and last_beat + bpm_time / 2.0 <= now:
+                display_modes[current_mode].go_wrap(True, volume, bands)
+                half_beat_done = True
+            else:
+                display_modes[current_mode].go_wrap(False, volume, bands)
 
             thruster.go()
+            pwm.show()
 
-
-            newtime = time.time()
-            elapsed = newtime - last_time
+            if watcher:
+                watcher.poll(now)
 
     except KeyboardInterrupt:
-        colorWipe(strip, Color(0,0,0), 10)
         for h in hx:
             h.set_rgb([0, 0, 0])
+        thruster.set(0.0)
+        pwm.show()
+        if output:
+            output.stop()
+        if neopixel:
+            colorWipe(neopixel, Color(0,0,0), 10)
+        if multistrip:
+            multistrip.close()
 
         shared_exiting.value = True
-        audio_process.join()
+        if audio_process:
+            audio_process.join()
 
     except:
         print("Error in main proc: %s" % sys.exc_info()[0])
         shared_exiting.value = True
-        audio_process.join()
+        if audio_process:
+            audio_process.join()
         raise
 
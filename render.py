@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Headless renderer for the display modes.  Runs a mode as fast as it will go on a
+# simulated clock, with a steady synthetic beat, and writes every frame to a .npy file
+# of shape (frames, leds, 3).  Good for previews, for timing a mode, and for checking
+# that a change didn't alter the output (--compare).
+
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+
+import dionysus
+
+MODES = {
+    "Shimmer":      dionysus.Shimmer,
+    "Chase":        dionysus.Chase,
+    "Shift":        dionysus.Shift,
+    "ShootingStar": dionysus.ShootingStar,
+}
+
+def render_mode(mode_class, path, frames, length=dionysus.LED_COUNT, bpm=120.0, volume=0.01):
+    """Render `frames` frames of a mode into `path`; returns (wall seconds, simulated seconds)."""
+    strip = dionysus.FilePixelDriver(path, length, frames)
+    pwm = dionysus.NullPWMDriver()
+    hx = [dionysus.LED(pwm, i * 3, i * 3 + 1, i * 3 + 2) for i in range(5)]
+    clock = dionysus.VirtualClock()
+    scheduler = dionysus.FrameScheduler(clock=clock)
+    mode = mode_class(strip, hx, clear=False, clock=clock)
+
+    beat_period = 60.0 / bpm
+    next_beat = 0.0
+
+    start = time.perf_counter()
+    for n in range(frames):
+        # on a virtual clock this just moves time on to the next deadline
+        scheduler.wait(mode.fps)
+        now = clock.tick()
+        is_beat = now >= next_beat
+        if is_beat:
+            next_beat += beat_period
+        mode.go_wrap(is_beat, volume)
+    elapsed = time.perf_counter() - start
+
+    strip.close()
+    return elapsed, clock.now
+
+def compare(path, reference):
+    """Indices of the frames that differ between two renders."""
+    a = np.load(path, mmap_mode="r")
+    b = np.load(reference, mmap_mode="r")
+    if a.shape != b.shape:
+        return None
+    return np.flatnonzero((a != b).reshape(len(a), -1).any(axis=1))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Render the Dionysus display modes to files, as fast as possible")
+    parser.add_argument("--modes", default=",".join(MODES),
+            help="comma-separated modes to render (default: all)")
+    parser.add_argument("--frames", type=int, default=3600, help="frames per mode (default: 3600)")
+    parser.add_argument("--leds", type=int, default=dionysus.LED_COUNT,
+            help="strip length (default: %d)" % dionysus.LED_COUNT)
+    parser.add_argument("--bpm", type=float, default=120.0, help="tempo of the synthetic beat (default: 120)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: 1)")
+    parser.add_argument("--out", default="renders", metavar="DIR",
+            help="where to write <mode>.npy (default: renders)")
+    parser.add_argument("--compare", metavar="DIR",
+            help="compare each render against <mode>.npy in DIR and report differing frames")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+
+    print("%-13s %7s %9s %10s %9s" % ("mode", "frames", "sim s", "wall s", "fps"))
+    for name in args.modes.split(","):
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        path = os.path.join(args.out, name + ".npy")
+        elapsed, simulated = render_mode(MODES[name], path, args.frames, args.leds, args.bpm)
+        print("%-13s %7d %9.1f %10.3f %9.1f" % (name, args.frames, simulated, elapsed, args.frames / elapsed))
+
+        if args.compare:
+            diff = compare(path, os.path.join(args.compare, name + ".npy"))
+            if diff is None:
+                print("    shape differs from the reference")
+            elif len(diff):
+                print("    %d frames differ, first at %d" % (len(diff), diff[0]))
+            else:
+                print("    matches the reference")